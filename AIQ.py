@@ -9,61 +9,585 @@
 #
 
 from refmachines import *
+from refmachines import BF_analyser, BF_profile, ProgramCorpus
+from refmachines.RandomStream import RandomStream
 from agents import *
 from math import isnan
-from time import sleep, localtime, strftime
+from time import time, sleep, localtime, strftime
 from scipy import ones, zeros, floor, array, sqrt, log, ceil, cov
-from random import choice
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from multiprocessing.managers import BaseManager
+from threading import Thread, Condition
+from collections import deque
+from Queue import Queue, Empty
+from traceback import format_exc
+from os.path import isfile, getmtime
+from os import rename, getpid, urandom
 
-import getopt, sys
+import getopt, sys, pickle, socket
 
 
 # Test an agent by performing both positive and negative reward runs in order
-# to get antithetic variance reduction. 
-def test_agent( refm_call, a_call, episode_length, disc_rate, stratum, program ):
+# to get antithetic variance reduction.  Copy counts the earlier runs of the
+# same program, so that each gets its own random numbers when seeded.
+def test_agent( refm_call, a_call, episode_length, disc_rate, stratum, program, copy=0 ):
+
+    # when profiling both runs are recorded in the same profile
+    if profiling: profile = BF_profile.Profile()
+    else:         profile = None
 
     # run twice with flipped reward second time
-    s1, r1 = _test_agent(refm_call, a_call,  1.0, episode_length,\
-                         disc_rate, stratum, program)
-    s2, r2 = _test_agent(refm_call, a_call, -1.0, episode_length, \
-                         disc_rate, stratum, program)
-
-    # log successful result to file
-    if logging and not isnan(r1) and not isnan(r2):
-        log_file.write( strftime("%Y_%m%d_%H:%M:%S ",localtime()) \
-              + str(s1) + " " + str(r1) + " " + str(r2) + "\n" )
-        log_file.flush()
-        
-    return (s1,r1,r2)
+    s1, r1, saved1 = _test_agent(refm_call, a_call,  1.0, episode_length,\
+                                 disc_rate, stratum, program, profile, copy)
+    s2, r2, saved2 = _test_agent(refm_call, a_call, -1.0, episode_length, \
+                                 disc_rate, stratum, program, profile, copy)
 
+    return (s1,r1,r2,saved1+saved2,profile)
 
-# Perform a single run of an agent in an enviornment and collect the results
-def _test_agent( refm_call, agent_call, rflip, episode_length, \
-                 disc_rate, stratum, program ):
 
-    # create reference machine
-    refm = eval( refm_call )
+# log a successful result to file, which is done by the main process as the
+# results come in so that the log matches the estimator's checkpoints.  The
+# perfs are the perf1 and perf2 of each agent.
+def log_result( stratum, perfs ):
+    log_file.write( strftime("%Y_%m%d_%H:%M:%S ",localtime()) + str(stratum) \
+          + "".join( [ " " + str(perf) for perf in perfs ] ) + "\n" )
+    log_file.flush()
 
-    # create agent
-    agent = eval( agent_call )
-    agent.reset()
 
-    disc_reward = 0.0
-    discount    = 1.0
+# The settings of the runs done by a worker process, set when the pool
+# starts the worker so that tasks only need to say which programs to run
+worker_args = None
+
+def init_worker( refm_call, agent_calls, episode_length, disc_rate ):
+    global worker_args
+    worker_args = (refm_call, agent_calls, episode_length, disc_rate)
+
+
+# Run test_agent in a worker for a chunk of (stratum, program, copy) items,
+# with each of the agents in turn, returning an array of perf1 and perf2 for
+# each agent followed by the total steps saved for each item, their profiles
+# if profiling, and the seconds taken.  Running the agents one after the
+# other on the same program, with the one reference machine (see
+# get_machines), means the program is only compiled once.  This
+# comes with the traceback of any exception, as a failed task would
+# otherwise never complete.
+def run_chunk( items ):
+    try:
+        start = time()
+        refm_call, agent_calls, episode_length, disc_rate = worker_args
+        results = zeros( (len(items), 2*len(agent_calls)+1) )
+        profiles = []
+        for i in range(len(items)):
+            stratum, program, copy = items[i]
+            profile = None
+            for a in range(len(agent_calls)):
+                result = test_agent( refm_call, agent_calls[a], episode_length, disc_rate,
+                                     stratum, program, copy )
+                results[i,2*a:2*a+2] = result[1:3]
+                results[i,-1] += result[3]
+                if profile == None: profile = result[4]
+                else:               profile.merge( result[4] )
+            profiles.append( profile )
+        if not profiling: profiles = None
+        return (results, profiles, time()-start), None
+    except Exception:
+        return None, format_exc()
+
+
+# Programs waiting to be run by the pool for stratified_estimator.  They are
+# sent to the workers in chunks, sized so that a chunk takes about CHUNK_TIME
+# seconds going by the times of the earlier chunks, but small enough to
+# share the last programs of a stage between the workers.  Each program is
+# given a number in the order they are added.  Completed chunks are put on
+# the completed queue by the pool's result thread, so results are handled
+# as they arrive.
+CHUNK_TIME = 0.2 # seconds
+MAX_CHUNK  = 100 # programs
+
+class Tasks:
+
+    def __init__( self, pool, workers ):
+        self.pool      = pool
+        self.workers   = workers
+        self.next      = 0       # number of the next program added
+        self.todo      = deque() # programs not yet sent to the pool
+        self.running   = 0       # chunks in the pool
+        self.item_time = None    # average seconds per program
+        self.completed = Queue()
+        self.items     = {}      # the programs not yet completed, by number
+
+    # add a program, with the given number if it had one in an earlier run
+    def add( self, stratum, program, copy, task=None ):
+        if task == None:
+            task = self.next
+            self.next += 1
+        self.todo.append( (task, stratum, program, copy) )
+        self.items[task] = (stratum, program, copy)
+
+    def busy( self ):
+        return len(self.todo) > 0 or self.running > 0
+
+    # the number of programs that takes about CHUNK_TIME
+    def time_size( self ):
+        if self.item_time == None: return 1
+        return max( min( int( CHUNK_TIME/self.item_time ), MAX_CHUNK ), 1 )
+
+    def chunk_size( self ):
+        size = min( self.time_size(), int(ceil( len(self.todo)/(2.0*self.workers) )) )
+        return max( size, 1 )
+
+    # send chunks to the pool, keeping two for each worker so none go idle
+    def dispatch( self ):
+        while len(self.todo) > 0 and self.running < 2*self.workers:
+            chunk = [ self.todo.popleft() \
+                      for i in range( min( self.chunk_size(), len(self.todo) ) ) ]
+            self.running += 1
+            self.send( chunk )
+
+    def send( self, chunk ):
+        items = [ (stratum, program, copy) for task, stratum, program, copy in chunk ]
+        self.pool.apply_async( run_chunk, (items,), callback = \
+            lambda result, chunk=chunk: self.completed.put( (chunk, result) ) )
+
+    # wait for the next chunk to complete, returning it and its result
+    def wait( self ):
+        return self.completed.get( True, 1e9 )
+
+    # wait for a chunk to complete, and return a list of its programs as
+    # (task, stratum, program, copy) along with the result and profile of each
+    def results( self ):
+        chunk, (result, error) = self.wait()
+        self.running -= 1
+        if error != None:
+            self.stop()
+            raise NameError("Test agent failed:\n" + error)
+
+        results, profiles, seconds = result
+        item_time = seconds/len(chunk)
+        if self.item_time == None: self.item_time = item_time
+        else:                      self.item_time = 0.8*self.item_time + 0.2*item_time
+
+        if profiles == None: profiles = [None]*len(chunk)
+        for item in chunk: del self.items[item[0]]
+        return zip( chunk, results, profiles )
+
+    # drop the programs waiting to be sent and stop the workers, without
+    # waiting for the runs in progress
+    def cancel( self ):
+        self.todo.clear()
+        self.running = 0
+        self.stop()
+
+    def stop( self ):
+        self.pool.terminate()
+        self.pool.join()
+
+    # finish with the workers once all the programs are done
+    def close( self ):
+        self.pool.close()
+        self.pool.join()
+
+
+# The workers for a run, in a local pool, or on the workers connected to
+# the coordinator if this is one (see serve)
+def start_tasks( refm_call, agent_calls, episode_length, disc_rate, threads ):
+    if board != None: return RemoteTasks( board )
+    if threads == 0: threads = cpu_count() # default threads = core count
+    pool = Pool( threads, init_worker, (refm_call, agent_calls, episode_length, disc_rate) )
+    return Tasks( pool, threads )
+
+
+# Runs spread over several machines.  One AIQ process is the coordinator,
+# which runs the estimator as usual, owning the allocation of programs to
+# strata and the program samples, but rather than using a local pool it
+# puts the chunks of programs on a Board that it serves over TCP with a
+# multiprocessing manager.  Worker processes, started on any machine with
+# --worker, connect to it, take chunks, run them with a local pool and
+# give back the results.  Workers can join at any time, and a worker that
+# hasn't been heard from for WORKER_TIMEOUT seconds is taken to have left,
+# with the chunks it had put back on the board for the other workers.  If
+# it turns up again any results for those chunks are ignored, as they come
+# second.  Workers check in every HEARTBEAT_TIME seconds while running.
+HEARTBEAT_TIME = 1.0  # seconds
+WORKER_TIMEOUT = 10.0 # seconds
+
+class Board:
+
+    def __init__( self, settings ):
+        self.settings = settings    # what the workers need to run programs
+        self.jobs     = deque()     # chunks waiting for a worker, as (number, items)
+        self.taken    = {}          # chunks being run, by number, as (worker, items)
+        self.workers  = {}          # (threads, last time seen) of each worker
+        self.joined   = {}          # threads of each worker that has joined
+        self.done     = Queue()     # completed chunks, as (number, result)
+        self.finished = False
+        self.lock     = Condition()
+
+    # called by the workers
+
+    def join( self, worker, threads ):
+        self.lock.acquire()
+        self.workers[worker] = (threads, time())
+        self.joined[worker] = threads
+        self.lock.release()
+        print "Worker " + worker + " joined with " + str(threads) + " threads"
+        return self.settings
+
+    # note that a worker is still running, including one that was taken to
+    # have left, so that it counts again
+    def heartbeat( self, worker ):
+        self.lock.acquire()
+        if worker in self.joined:
+            self.workers[worker] = (self.joined[worker], time())
+        self.lock.release()
+
+    # the next chunk for a worker, waiting up to wait seconds for one, or
+    # None if there isn't one
+    def take( self, worker, wait=0.0 ):
+        self.heartbeat( worker )
+        self.lock.acquire()
+        if len(self.jobs) == 0 and wait > 0.0 and not self.finished:
+            self.lock.wait( wait )
+        job = None
+        if len(self.jobs) > 0:
+            job = self.jobs.popleft()
+            self.taken[job[0]] = (worker, job[1])
+        self.lock.release()
+        return job
+
+    # a chunk that was given to another worker after this one was taken to
+    # have left is still that worker's, in case it leaves too
+    def finish( self, worker, number, result ):
+        self.heartbeat( worker )
+        self.lock.acquire()
+        if number in self.taken and self.taken[number][0] == worker:
+            del self.taken[number]
+        self.lock.release()
+        self.done.put( (number, result) )
+
+    def is_finished( self ):
+        return self.finished
+
+    def leave( self, worker ):
+        self.lock.acquire()
+        if worker in self.workers: del self.workers[worker]
+        if worker in self.joined:  del self.joined[worker]
+        self.lock.release()
+
+    # called by the coordinator
+
+    def put( self, number, items ):
+        self.lock.acquire()
+        self.jobs.append( (number, items) )
+        self.lock.notify()
+        self.lock.release()
+
+    # the threads of the workers that are still running
+    def threads( self ):
+        self.lock.acquire()
+        threads = sum( [ worker_threads for worker_threads, seen in self.workers.values() ] )
+        self.lock.release()
+        return threads
+
+    # drop the workers that haven't been seen for WORKER_TIMEOUT seconds,
+    # putting their chunks at the front of the queue
+    def expire( self ):
+        self.lock.acquire()
+        lost = [ worker for worker, (threads, seen) in self.workers.items() \
+                 if time()-seen > WORKER_TIMEOUT ]
+        for worker in lost:
+            del self.workers[worker]
+            for number in sorted( self.taken, reverse=True ):
+                if self.taken[number][0] == worker:
+                    self.jobs.appendleft( (number, self.taken.pop(number)[1]) )
+                    self.lock.notify()
+        self.lock.release()
+        for worker in lost: print "Worker " + worker + " lost, its programs will be run again"
+
+    def clear( self ):
+        self.lock.acquire()
+        self.jobs.clear()
+        self.taken = {}
+        self.lock.release()
+
+    # tell the workers the run has finished, and give them up to
+    # WORKER_TIMEOUT seconds to leave, and then time to disconnect, so
+    # the server isn't still talking to them as this process exits
+    def close( self ):
+        self.lock.acquire()
+        self.finished = True
+        self.lock.notify_all()
+        self.lock.release()
+        end = time() + WORKER_TIMEOUT
+        while self.threads() > 0 and time() < end:
+            self.expire()
+            sleep( 0.1 )
+        sleep( HEARTBEAT_TIME )
+
+
+class Coordinator( BaseManager ): pass
+
+Coordinator.register( "board" )
+
+board = None # the board of the coordinator, if this is one
+
+# Serve the board for this run, with the settings of its runs, at an
+# address of (host, port), so that workers can connect to it
+def serve( address, authkey, settings ):
+    global board
+    board = Board( settings )
+    Coordinator.register( "board", callable=lambda: board )
+    server = Coordinator( address=address, authkey=authkey ).get_server()
+    thread = Thread( target=server.serve_forever )
+    thread.daemon = True
+    thread.start()
+
+
+# The chunks for the estimator to run on the board, sized and kept topped up
+# as for a local pool, but with the threads of the workers connected now
+class RemoteTasks( Tasks ):
+
+    def __init__( self, board ):
+        Tasks.__init__( self, None, 1 )
+        self.board  = board
+        self.chunks = {} # chunks on the board, by number
+        self.next_chunk = 0
+        self.last_expire = time()
+
+    def dispatch( self ):
+        self.workers = max( self.board.threads(), 1 )
+        Tasks.dispatch( self )
+
+    def send( self, chunk ):
+        items = [ (stratum, program, copy) for task, stratum, program, copy in chunk ]
+        self.chunks[self.next_chunk] = chunk
+        self.board.put( self.next_chunk, items )
+        self.next_chunk += 1
+
+    # wait for a chunk that hasn't already come back, checking for lost
+    # workers every HEARTBEAT_TIME seconds, whether or not results arrive
+    def wait( self ):
+        while True:
+            if time()-self.last_expire >= HEARTBEAT_TIME:
+                self.board.expire()
+                self.last_expire = time()
+            try:
+                number, result = self.board.done.get( True, HEARTBEAT_TIME )
+            except Empty:
+                continue
+            if number in self.chunks: return self.chunks.pop( number ), result
+
+    def stop( self ):
+        self.board.clear()
+        self.chunks = {}
+
+    def close( self ):
+        self.board.close()
+
+
+# Run the chunks from a coordinator at an address of (host, port), with a
+# local pool of threads, until the coordinator finishes or goes away.  The
+# worker waits for the coordinator if it hasn't started yet.
+def run_worker( address, authkey, threads ):
+
+    global profiling, run_seed
+
+    manager = Coordinator( address=address, authkey=authkey )
+    waiting = False
+    while True:
+        try:
+            manager.connect()
+            break
+        except socket.error:
+            if not waiting:
+                print "Waiting for the coordinator at " + address[0] + ":" + str(address[1])
+                waiting = True
+            sleep( HEARTBEAT_TIME )
+    remote = manager.board()
+
+    name = socket.gethostname() + ":" + str(getpid())
+    if threads == 0: threads = cpu_count() # default threads = core count
+    refm_call, agent_calls, episode_length, disc_rate, run_seed, profiling \
+        = remote.join( name, threads )
+    print "Joined the coordinator at " + address[0] + ":" + str(address[1]) \
+          + " as " + name + " running " + ", ".join( agent_calls )
+
+    pool = Pool( threads, init_worker, (refm_call, agent_calls, episode_length, disc_rate) )
+    completed = Queue()
+    running = 0
+    chunks = 0
+    try:
+        while True:
+            # keep two chunks for each thread
+            while running < 2*threads:
+                if running == 0: job = remote.take( name, HEARTBEAT_TIME )
+                else:            job = remote.take( name )
+                if job == None: break
+                number, items = job
+                pool.apply_async( run_chunk, (items,), callback = \
+                    lambda result, number=number: completed.put( (number, result) ) )
+                running += 1
+
+            if running == 0:
+                if remote.is_finished():
+                    remote.leave( name )
+                    break
+                continue
+
+            try:
+                number, result = completed.get( True, HEARTBEAT_TIME )
+                remote.finish( name, number, result )
+                running -= 1
+                chunks += 1
+            except Empty:
+                remote.heartbeat( name )
+
+        print "The coordinator has finished"
+    except (EOFError, IOError):
+        print "Lost the coordinator"
+    print "Ran " + str(chunks) + " chunks of programs"
+
+    pool.terminate()
+    pool.join()
+
+
+# When to stop a run before its sample size is reached: once the 95% half
+# CI is at most target_ci, if given, which is only trusted after MIN_SAMPLES
+# samples (see the Readme), or once time_limit seconds have passed, if given.
+MIN_SAMPLES = 1000
+
+class Stopping:
+
+    def __init__( self, target_ci=None, time_limit=None ):
+        self.target_ci  = target_ci
+        self.time_limit = time_limit
+        self.start      = time()
+        self.reason     = None
+
+    # Check whether to stop, given a function returning the number of
+    # samples, estimate and half CI so far, which is only called if needed.
+    # Returns the reason to stop, or None.
+    def check( self, estimate ):
+        if self.time_limit != None and time()-self.start >= self.time_limit:
+            self.reason = "time limit of " + str(self.time_limit) + " seconds reached"
+        elif self.target_ci != None:
+            samples, est, delta = estimate()
+            if samples >= MIN_SAMPLES and delta <= self.target_ci:
+                self.reason = "half CI of %.2f is within the target of %s" \
+                              % (delta, str(self.target_ci))
+        return self.reason
+
+
+# Checkpoints of stratified_estimator, saved every CHECKPOINT_TIME seconds
+# during a stage and at the end of each stage, so that a run can be resumed
+# or extended to a larger sample size.  A checkpoint is a pickled dict of
+# the estimator's state, written to a temporary file first so that a run
+# dying while saving one doesn't lose the last one.
+CHECKPOINT_TIME = 60 # seconds
+
+def save_checkpoint( file_name, state ):
+    checkpoint_file = open( file_name + ".tmp", 'wb' )
+    pickle.dump( state, checkpoint_file, 2 )
+    checkpoint_file.close()
+    rename( file_name + ".tmp", file_name )
+
+def load_checkpoint( file_name ):
+    checkpoint_file = open( file_name, 'rb' )
+    state = pickle.load( checkpoint_file )
+    checkpoint_file.close()
+    return state
+
+
+# The number of samples, estimate and 95% half CI from the antithetic pairs
+# of results in each stratum, Y, along with a list of more results as
+# (stratum, perf1, perf2).  The half CI is from the standard deviation of
+# the pairs in each stratum, which is 1 until a stratum has two pairs, the
+# same as the adaptive estimators use.  With several agents the results
+# have the perf1 and perf2 of each agent in turn, and this is the estimate
+# for the given agent, or for the difference of its results from those of
+# the base agent if one is given.
+def current_estimate( p, Y, more=[], agent=0, base=None ):
+
+    I = len(p)
+    Y = [ list(Y[i]) for i in range(I) ]
+    for result in more:
+        Y[result[0]].append( result[1:] )
+
+    n = zeros((I))
+    s = ones((I))
+    est = 0.0
+    for i in range(1,I):
+        if p[i] > 0.0 and len(Y[i]) > 0:
+            YA = array(Y[i])
+            values = YA[:,2*agent:2*agent+2]
+            if base != None: values = values - YA[:,2*base:2*base+2]
+            n[i] = 2*len(YA)
+            est += p[i]/n[i] * values.sum()
+            if len(YA) >= 2: s[i] = values.mean(axis=1).std(ddof=1)
+
+    sampled = n > 0
+    delta = 1.96 * sqrt( sum( p[sampled]**2 * s[sampled]**2 / n[sampled] ) )
+    return n.sum(), est, delta
+
+
+# Report the estimate for each of several agents tested on the same
+# programs, and the difference of each of the others from the first.  As
+# the results are paired by program much of the variation between programs
+# cancels out of the differences, so their CIs are narrower than those of
+# the agents' own estimates.
+def report_agents( p, Y, names ):
+    print
+    for agent in range(len(names)):
+        print "         %6i   % 5.1f +/- % 5.1f   " % current_estimate( p, Y, [], agent ) \
+              + names[agent]
+    for agent in range(1,len(names)):
+        samples, est, delta = current_estimate( p, Y, [], agent, 0 )
+        print "     difference   % 5.1f +/- % 5.1f   " % (est, delta) \
+              + names[agent] + " - " + names[0]
+
+
+# The reference machine of this process for each call, and the agent for
+# each agent call on it.  They are kept between runs and reset, as making
+# them can take longer than a short run.  All the agents share the one
+# reference machine, which only compiles a program when it isn't the one it
+# ran last, so when several agents run the same program in turn it is only
+# compiled once.
+machines = {}
+machine_agents = {}
+
+def get_machines( refm_call, agent_call ):
+    if refm_call not in machines:
+        machines[refm_call] = eval( refm_call )
+    refm = machines[refm_call]
+    if (refm_call, agent_call) not in machine_agents:
+        machine_agents[(refm_call, agent_call)] = eval( agent_call )
+    return refm, machine_agents[(refm_call, agent_call)]
+
+
+# Perform a single run of an agent in an enviornment and collect the results,
+# along with the number of steps the reference machine managed to skip.
+# If a profile is given the reference machine's cycles are recorded in it.
+def _test_agent( refm_call, agent_call, rflip, episode_length, \
+                 disc_rate, stratum, program, profile=None, copy=0 ):
 
-    reward, observations = refm.reset( program )
+    # get reference machine and agent
+    refm, agent = get_machines( refm_call, agent_call )
+    refm.profile = profile
+    agent.reset()
+    steps_saved = refm.steps_saved
 
-    for i in range( episode_length ):
-        action = agent.perceive( observations, rflip*reward )
-        reward, observations, steps = refm.act( action )
+    # when seeded the random numbers only depend on the run, not the worker,
+    # and the machine gets the same ones whatever the agent is
+    if run_seed != None:
+        refm.rng  = RandomStream( run_seed, program, copy, rflip > 0, "refm" )
+        agent.rng = RandomStream( run_seed, program, copy, rflip > 0, "agent" )
 
-        # we signal failure with a NaN so as not to upset
-        # the parallel map running this with an exception
-        if steps == refm.max_steps: return (stratum,float('nan'))
+    disc_reward, failed = refm.run_episode( agent, episode_length, disc_rate, \
+                                            rflip, program )
 
-        disc_reward += discount*rflip*reward
-        discount    *= disc_rate
+    # we signal failure with a NaN so as not to upset
+    # the parallel map running this with an exception
+    if failed: return (stratum,float('nan'),refm.steps_saved-steps_saved)
 
     # if discounting normalise (and thus correct for missing tail)
     if disc_rate != 1.0:
@@ -72,26 +596,30 @@ def _test_agent( refm_call, agent_call, rflip, episode_length, \
 	    # otherwise just normalise by the episode length
         disc_reward /= episode_length
 
-    # dispose of agent and reference machine
-    agent = None
-    refm  = None
-    
-    return stratum, disc_reward
+    return stratum, disc_reward, refm.steps_saved-steps_saved
 
 
 
 # Simple MC estimator, useful for checking the more complex adaptive estimator.
 # It doesn't do logging as the log file assumes dual runs for antithetic variables.
 def simple_mc_estimator( refm_call, agent_call, episode_length, disc_rate, \
-                         sample_size ):
+                         samples, sample_size ):
 
     print
-    result = zeros((len(sample_data)))
+    result = zeros((len(samples)))
+    profiles = {}
+    copies = {}
+    if run_seed != None: rflips = RandomStream( run_seed, "rflip" )
+    else:                rflips = RandomStream()
     i = 0
-    for stratum, program in sample_data:
-        rflip = choice([-1,1])
+    for stratum, program in samples.programs():
+        rflip = 2*rflips.randrange(2)-1
+        copy = copies[program] = copies.get( program, -1 ) + 1
+        if profiling: profile = BF_profile.Profile()
+        else:         profile = None
         perf = _test_agent( refm_call, agent_call, rflip, episode_length, disc_rate, \
-                            stratum, program )[1]
+                            stratum, program, profile, copy )[1]
+        if profiling: add_profile( profiles, stratum, program, profile )
         if not isnan(perf):
             result[i] = perf
             if i%10 == 0 and i > 10:
@@ -101,6 +629,43 @@ def simple_mc_estimator( refm_call, agent_call, episode_length, disc_rate, \
             i += 1
             if i >= sample_size: break
 
+    return profiles
+
+
+# add the profile of a program's runs to the profiles for its stratum and the
+# program itself
+def add_profile( profiles, stratum, program, profile ):
+
+    if profiles == {}:
+        profiles['strata']   = {}
+        profiles['programs'] = {}
+
+    strata = profiles['strata']
+    if stratum not in strata: strata[stratum] = BF_profile.Profile()
+    strata[stratum].merge( profile )
+
+    programs = profiles['programs']
+    if program not in programs: programs[program] = BF_profile.Profile()
+    programs[program].merge( profile )
+
+
+# Get the next program sample for a stratum, skipping any that can be proven to
+# go over time during an episode as every run of them would fail.  Returns the
+# program and the number of times it has been returned before.
+def next_program( refm, samples, stratum, episode_length, copies ):
+
+    while True:
+        program = samples.draw( stratum )
+
+        if program == None:
+            print "Error: Run out of program samples in stratum: " + str(stratum)
+            sys.exit()
+
+        if not isinstance( refm, BF.BF ) \
+               or not BF_analyser.overtime( refm, program, episode_length ):
+            copies[program] = copies.get( program, -1 ) + 1
+            return program, copies[program]
+
 
 # Adaptive stratified estimator
 #
@@ -108,8 +673,16 @@ def simple_mc_estimator( refm_call, agent_call, episode_length, disc_rate, \
 #
 # N total number of samples taken in each step (i.e. across all strata)
 # p probability of being in a stratum
-def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samples, \
-                          sample_size, dist, threads ):
+#
+# If a checkpoint file name is given the state is saved to it as the run goes,
+# and if the state from a checkpoint is given the run carries on from it,
+# finishing its last stage if it was part way through one and then going on
+# to the sample size, which can be larger than that of the original run.
+def stratified_estimator( refm_call, agent_calls, episode_length, disc_rate, samples, \
+                          sample_size, dist, threads, stopping=None, \
+                          checkpoint=None, state=None ):
+
+    refm = eval( refm_call ) # used to screen out programs before running them
 
     p = dist         # get probability of being in each stratum
     I = len(dist)    # number of strata, including passive
@@ -124,12 +697,21 @@ def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samp
          1250*A, 1500*A, 1750*A, 2000*A, 2500*A, 3000*A, 3500*A, 4000*A, 5000*A]
 
     # trim to number of program samples, or requested sample size, which ever is smaller
-    max_samples = min( len(sample_data), sample_size )
+    max_samples = min( len(samples), sample_size )
     for i in range(len(N)):
         if N[i]+A >= max_samples:
             N[i] = float(max_samples)
             N = N[:i+1]
             break
+
+    # carry on from the last stage of a checkpoint, and any part done stage
+    settings = (refm_call, agent_calls, episode_length, disc_rate, list(dist), run_seed)
+    if state != None:
+        if state['settings'] != settings:
+            raise NameError("The checkpoint is from a run with different settings")
+        steps = [ state['N'] ]
+        if state['stage_N'] > state['N']: steps.append( state['stage_N'] )
+        N = steps + [ size for size in N if size > steps[-1] ]
         
     print "Sample size steps:"
     print N
@@ -140,7 +722,56 @@ def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samp
     s = ones((K,I))            # estimated standard deviations for each stage & strata
     n = zeros((K,I))           # for each step the size of each stratum
     est = zeros((K))           # estimated confidence intervals
-
+    saved = zeros((I))         # steps skipped by the reference machine
+    profiles = {}              # profiles of the reference machine, if profiling
+    copies = {}                # number of times each program has been run
+
+    # one pool of workers for the whole run
+    tasks = start_tasks( refm_call, agent_calls, episode_length, disc_rate, threads )
+
+    def submit( stratum ):
+        program, copy = next_program( refm, samples, stratum, episode_length, copies )
+        tasks.add( stratum, program, copy )
+
+    # with several agents each program is run by all of them, and Y has the
+    # perf1 and perf2 of each agent in turn
+    agents = len(agent_calls)
+    names = [ str( eval( agent_call ) ) for agent_call in agent_calls ]
+
+    # the estimate with the widest half CI of the agents
+    def estimate( more=[] ):
+        return max( [ current_estimate( p, Y, more, agent ) for agent in range(agents) ],
+                    key=lambda estimate: estimate[2] )
+
+    stages = 0 # stages finished before this run
+    if state != None:
+        stages = state['stages']
+        Y, s[0], n[0] = state['Y'], state['s'], state['n']
+        saved, profiles, copies = state['saved'], state['profiles'], state['copies']
+        samples.cursors = state['cursors']
+        tasks.next = state['next_task']
+
+    # Save the state of the run, at the end of stage k, or part way through it
+    # along with the results so far and the programs still to be run
+    def save( k, part_done ):
+        if part_done: last = k-1
+        else:         last = k
+        checkpoint_state = { 'settings' : settings, 'stages' : stages+last,
+                             'N' : N[last], 'stage_N' : N[last],
+                             'Y' : Y, 's' : s[last], 'n' : n[last], 'saved' : saved,
+                             'profiles' : profiles, 'copies' : copies,
+                             'cursors' : list( samples.cursors ), 'next_task' : tasks.next,
+                             'log' : None }
+        if part_done:
+            checkpoint_state.update( { 'stage_N' : N[k], 'M' : M, 'stage' : stage,
+                                       'items' : tasks.items } )
+        if logging:
+            log_file.flush()
+            checkpoint_state['log'] = (log_file.name, log_file.tell())
+        save_checkpoint( checkpoint, checkpoint_state )
+        return time()
+
+    last_save = time()
     for k in range( 1, K ):
         print
 
@@ -162,75 +793,84 @@ def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samp
         # make sure each non-zero probability stratum gets sampled at least twice
         M = x + 2.0*ceil(p)
         
-        # create parallel computation pool
-        if threads == 0:
-            pool = Pool() # default threads = core count
-        else:
-            pool = Pool(threads)
-        results = []
-
         # add samples to processing pool (we skip stratum 0 which is passive)
-        for i in range(1,I):
-            for j in range(int(M[i])/2): # /2 is due to sampling each program twice
-
-                if len(samples[i]) == 0:
-                    print "Error: Run out of program samples in stratum: " + str(i)
-                    sys.exit()
-
-                program = samples[i].pop(0)
-                args = (refm_call, agent_call, episode_length, disc_rate, i, program)
-                result = pool.apply_async( test_agent, args )
-                results.append( result )
-
-        # collect the results, adding new jobs to the pool for any failed runs
-        while results != []:
-            result = results.pop(0)
-
-            if not result.ready():
-                # put back in the results list at the end and sleep for a moment
-                results.append( result )
-                sleep(0.02)
-            else:
-                # completed, now get the results
-                stratum, perf1, perf2 = result.get(100)
-                
-                if isnan(perf1) or isnan(perf2):
+        stage = {}
+        if k == 1 and state != None and state['stage_N'] > state['N']:
+            # finish the stage the checkpoint was part way through
+            M, stage = state['M'], state['stage']
+            for task in sorted( state['items'] ):
+                stratum, program, copy = state['items'][task]
+                tasks.add( stratum, program, copy, task )
+        else:
+            for i in range(1,I):
+                for j in range(int(M[i])/2): # /2 is due to sampling each program twice
+                    submit( i )
+
+        # collect the results as they complete, adding new jobs to the pool
+        # for any failed runs
+        tasks.dispatch()
+        while tasks.busy():
+            for (task, stratum, program, copy), result, profile in tasks.results():
+                perfs = tuple( result[:-1] )
+                saved[stratum] += result[-1]
+                if profile != None:
+                    add_profile( profiles, stratum, program, profile )
+
+                if any( [ isnan( perf ) for perf in perfs ] ):
                     # run failed so get a new sample and add to processing pool
                     #print "Adding extra sample to the pool due to run failure"
-                    if len(samples[stratum]) == 0:
-                        print "Error: Run out of program samples in stratum: " \
-                              + str(stratum)
-                        sys.exit()
-
-                    program = samples[stratum].pop(0)
-                    args = (refm_call, agent_call, episode_length, disc_rate, stratum, program)
-                    result = pool.apply_async( test_agent, args )
-                    results.append( result )
+                    submit( stratum )
+                    stage[task] = None
                 else:
-                    # run succeeded, so add the result to our results table Y
-                    Y[stratum].append( (perf1, perf2) )
-
-        pool.close()
-        pool.join()
+                    stage[task] = (stratum,) + perfs
+                    if logging: log_result( stratum, perfs )
+
+            if stopping != None and stopping.check( lambda: estimate( \
+                    [ result for result in stage.values() if result != None ] ) ):
+                if checkpoint != None: save( k, True )
+                tasks.cancel()
+                break
+            if checkpoint != None and time()-last_save >= CHECKPOINT_TIME:
+                last_save = save( k, True )
+            tasks.dispatch()
+
+        # add the results to our results table Y in the order the programs
+        # were submitted, so they don't depend on which runs finished first
+        for task in sorted( stage ):
+            if stage[task] != None:
+                Y[stage[task][0]].append( stage[task][1:] )
+
+        # report the estimate from all the results so far if stopping early
+        if stopping != None and stopping.reason != None:
+            print
+            print "Stopped early as the " + stopping.reason
+            if agents == 1:
+                print "\n         %6i   % 5.1f +/- % 5.1f " % current_estimate( p, Y )
+            else:
+                report_agents( p, Y, names )
+            break
 
 
         # compute new total program sample counts for each strata
         n[k] = n[k-1] + M
 
-        # compute empirical standard deviations for each stratum
+        # compute empirical standard deviations for each stratum, pooled
+        # over the agents if there are several
         for i in range(1,I):
             if p[i] > 0.0 and n[k][i] > 2:
 
                 YA = array(Y[i])
-                sample1 = YA[:,0] # positive antithetic runs
-                sample2 = YA[:,1] # negative antithetic runs
+                var = 0.0
+                for agent in range(agents):
+                    sample1 = YA[:,2*agent]   # positive antithetic runs
+                    sample2 = YA[:,2*agent+1] # negative antithetic runs
 
-                s1 = sample1.std(ddof=1) # 1 degree of freedom
-                s2 = sample2.std(ddof=1) # 1 degree of freedom
-                covariance = cov( sample1, sample2 )[0,1] # default is 1 df
+                    s1 = sample1.std(ddof=1) # 1 degree of freedom
+                    s2 = sample2.std(ddof=1) # 1 degree of freedom
+                    covariance = cov( sample1, sample2 )[0,1] # default is 1 df
 
-                var = 0.25 * ( s1*s1 + s2*s2 + 2.0 * covariance )
-                s[k,i] = sqrt( var )
+                    var += 0.25 * ( s1*s1 + s2*s2 + 2.0 * covariance )
+                s[k,i] = sqrt( var/agents )
             else:
                 s[k,i] = 1.0
 
@@ -241,6 +881,12 @@ def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samp
             if n[k][i] == 0: 
                 # no samples, so skip mean and half CI
                 print
+            elif agents > 1:
+                # the mean of each agent
+                YA = array(Y[i])
+                for agent in range(agents):
+                    print " % 6.1f" % (YA[:,2*agent:2*agent+2].mean() ),
+                print
             elif n[k][i] < 4: 
                 # don't report half CI with less than 4 program samples
                 print " % 6.1f" % (array(Y[i]).mean() )
@@ -249,54 +895,290 @@ def stratified_estimator( refm_call, agent_call, episode_length, disc_rate, samp
                 # statistical samples is twice program samples due to antithetic vars
                 print " % 6.1f +/- % 5.1f" \
                    % (array(Y[i]).mean(), 1.96*s[k,i]/sqrt(n[k][i]) )
+
                     
         # compute the current estimate and 95% confidence interval
-        for i in range(1,I):
-            if p[i] > 0.0:
-                est[k-1] += p[i]/( n[k][i]) * array(Y[i]).sum()
+        if agents == 1:
+            for i in range(1,I):
+                if p[i] > 0.0:
+                    est[k-1] += p[i]/( n[k][i]) * array(Y[i]).sum()
 
-        delta = 1.96 * sum( p*s[k] ) / sqrt( N[k] )
+            delta = 1.96 * sum( p*s[k] ) / sqrt( N[k] )
         
         # wait until after 3rd stage due to unreliable early statistics
-        if k >= min(3,K-1):
-            print "\n         %6i   % 5.1f +/- % 5.1f " % (N[k], est[k-1], delta )
+        if stages+k >= min(3,stages+K-1):
+            if agents == 1:
+                print "\n         %6i   % 5.1f +/- % 5.1f " % (N[k], est[k-1], delta )
+            else:
+                report_agents( p, Y, names )
+
+        if checkpoint != None: last_save = save( k, False )
         
-    return
+    tasks.close()
 
+    # report the steps saved by the reference machine finding repeated states,
+    # which mostly comes from runs that fail by going over time
+    if saved.sum() > 0:
+        print
+        print "Steps saved by finding repeated states, by stratum:"
+        print saved[1:]
 
+    return profiles
 
-# load the pre-sampled programs
-sample_data = None
 
-def load_samples( refm, cluster_node, simple_mc ):
+# Online adaptive stratified estimator
+#
+# Rather than working in stages, this picks the stratum of each program when
+# it is needed to keep the workers busy, so the workers never wait for the
+# slowest run of a stage.  Each program goes to the stratum that is furthest
+# below its share of the programs so far under Neyman allocation, which is
+# proportional to p times the standard deviation of the stratum, going by
+# the results that have come in.  Every stratum first gets two programs so
+# that it has a standard deviation, and then another each time a report is
+# made, as a stratum gets one in each stage of stratified_estimator, so
+# that a stratum that happened to get similar results at first isn't left
+# behind.  The programs in the pool count towards
+# their strata, and a failed run gives its place back.  The estimate is
+# reported when the number of samples reaches each of the report sizes, or
+# by default the sample size steps of stratified_estimator.  As strata are
+# chosen by the results that have come in so far, runs with a seed are only
+# repeatable with the same number of threads and timing.
+def online_estimator( refm_call, agent_call, episode_length, disc_rate, samples, \
+                      sample_size, dist, threads, reports=None, stopping=None ):
+
+    refm = eval( refm_call ) # used to screen out programs before running them
 
-    global sample_data
+    p = dist         # get probability of being in each stratum
+    I = len(dist)    # number of strata, including passive
+    A = sum(ceil(p)) # active strata
 
-    program_sample_filename = "./refmachines/samples/" + str(refm) \
-                              + cluster_node + ".samples"
+    # trim to number of program samples, or requested sample size, which ever
+    # is smaller, with two samples for each program due to antithetic vars
+    max_samples = min( len(samples), sample_size )
+    programs = int(max_samples)/2
+
+    if reports == None:
+        reports = [ 3*A, 6*A, 10*A, 20*A, 30*A, 50*A, 70*A, 100*A, 250*A, 500*A, \
+                    750*A, 1000*A, 1250*A, 1500*A, 1750*A, 2000*A, 2500*A, 3000*A, \
+                    3500*A, 4000*A, 5000*A ]
+    reports = [ r for r in reports if r < 2*programs ] + [ 2*programs ]
+
+    print "Report at sample sizes:"
+    print reports
+
+    Y = [[] for i in range(I)] # results divided up by stratum
+    total   = zeros((I))       # sum of the mean of each pair of results
+    squares = zeros((I))       # sum of the squares of the means
+    n = zeros((I))             # number of samples in each stratum
+    last_n = zeros((I))        # n at the last report
+    allocated = zeros((I))     # programs in each stratum, including in the pool
+    minimum = [2]              # least programs in each stratum
+    saved = zeros((I))         # steps skipped by the reference machine
+    profiles = {}              # profiles of the reference machine, if profiling
+    copies = {}                # number of times each program has been run
+
+    # one pool of workers for the whole run
+    tasks = start_tasks( refm_call, [agent_call], episode_length, disc_rate, threads )
+
+    # the standard deviation of the mean of a pair of results in each stratum,
+    # which is 1 until a stratum has two pairs
+    def deviations():
+        s = ones((I))
+        pairs = n/2.0
+        for i in range(1,I):
+            if pairs[i] >= 2:
+                var = (squares[i] - total[i]*total[i]/pairs[i]) / (pairs[i]-1.0)
+                s[i] = sqrt( max( var, 0.0 ) )
+        return s
+
+    # the next stratum to get a program
+    def allocate():
+        active = (p > 0.0)
+        active[0] = False
+        short = active & (allocated < minimum[0])
+        if short.any(): return int( short.nonzero()[0][0] )
+
+        s = deviations()
+        target = (allocated.sum()+1.0) * p*s/sum(p[active]*s[active])
+        target[~active] = -1e10
+        return int( (target-allocated).argmax() )
+
+    # add programs until there are enough to keep the pool busy
+    def fill():
+        while allocated.sum() < programs \
+                  and len(tasks.todo) < 2*tasks.workers*tasks.time_size():
+            stratum = allocate()
+            program, copy = next_program( refm, samples, stratum, episode_length, copies )
+            tasks.add( stratum, program, copy )
+            allocated[stratum] += 1
+
+    # the number of samples, estimate and 95% half CI so far
+    def estimate():
+        s = deviations()
+        sampled = (p > 0.0) & (n > 0)
+        est = sum( p[sampled] * total[sampled] * 2.0/n[sampled] )
+        delta = 1.96 * sqrt( sum( p[sampled]**2 * s[sampled]**2 / n[sampled] ) )
+        return n.sum(), est, delta
+
+    def report():
+        print
+        s = deviations()
+        for i in range(1,I):
+            print " % 3d % 4d % 5d" % (i, int(n[i]-last_n[i]), n[i] ),
 
-    print "Loading program samples: " + program_sample_filename
+            if n[i] == 0:
+                # no samples, so skip mean and half CI
+                print
+            elif n[i] < 4:
+                # don't report half CI with less than 4 program samples
+                print " % 6.1f" % (array(Y[i]).mean() )
+            else:
+                print " % 6.1f +/- % 5.1f" \
+                   % (array(Y[i]).mean(), 1.96*s[i]/sqrt(n[i]) )
+        last_n[:] = n
+
+        print "\n         %6i   % 5.1f +/- % 5.1f " % estimate()
+
+    fill()
+    tasks.dispatch()
+    while tasks.busy():
+        for (task, stratum, program, copy), (perf1, perf2, steps_saved), profile \
+                in tasks.results():
+            saved[stratum] += steps_saved
+            if profile != None:
+                add_profile( profiles, stratum, program, profile )
+
+            if isnan(perf1) or isnan(perf2):
+                # run failed so give its place to another program
+                allocated[stratum] -= 1
+            else:
+                Y[stratum].append( (perf1, perf2) )
+                if logging: log_result( stratum, (perf1, perf2) )
+                total[stratum]   += (perf1+perf2)/2.0
+                squares[stratum] += ((perf1+perf2)/2.0)**2
+                n[stratum] += 2
+                while reports != [] and n.sum() >= reports[0]:
+                    reports.pop(0)
+                    minimum[0] += 1
+                    report()
+
+        if stopping != None and stopping.check( estimate ):
+            tasks.cancel()
+            print
+            print "Stopped early as the " + stopping.reason
+            report()
+            break
+
+        fill()
+        tasks.dispatch()
 
-    file = open( program_sample_filename )
+    tasks.close()
 
-    num_strata = 0
-    sample_data = []
-    for line in file:
-        s, prog = line.split()
-        stratum = int(s)
-        num_strata = max( num_strata, stratum )
-        sample_data.append( ( stratum, prog ) )
-    file.close()
+    # report the steps saved by the reference machine finding repeated states,
+    # which mostly comes from runs that fail by going over time
+    if saved.sum() > 0:
+        print
+        print "Steps saved by finding repeated states, by stratum:"
+        print saved[1:]
 
-    num_strata += 1 # due to strata starting at 0
-    num_samples = len( sample_data )
+    return profiles
 
-    samples = [[] for i in range(num_strata)]
-    dist = zeros( (num_strata) )
 
-    for stratum, program in sample_data:
-        samples[ stratum ].append( program )
-        dist[ stratum ] += 1.0/num_samples
+
+# Load the pre-sampled programs, from a corpus file made by ProgramCorpus if
+# there is one, or else from the text sample file.  The programs are returned
+# as a corpus, which gives the next program of each stratum in turn.
+def load_samples( refm, cluster_node, simple_mc, substrata=[] ):
+
+    program_sample_filename = "./refmachines/samples/" + str(refm) \
+                              + cluster_node + ".samples"
+    corpus_filename = program_sample_filename[:-len(".samples")] + ".corpus"
+
+    if isfile( corpus_filename ):
+        print "Loading program corpus:  " + corpus_filename
+        if isfile( program_sample_filename ) \
+               and getmtime( program_sample_filename ) > getmtime( corpus_filename ):
+            print "Warning: the program sample file is newer than the corpus"
+        samples = ProgramCorpus.load_corpus( corpus_filename )
+    else:
+        print "Loading program samples: " + program_sample_filename
+        samples = ProgramCorpus.load_text( program_sample_filename )
+
+    num_strata  = samples.num_strata
+    num_samples = len( samples )
+
+    # A sample file made by BF_sampler in quota mode only keeps some of the
+    # programs sampled in each stratum.  The number sampled in each stratum
+    # is then in a counts file, which gives the strata probabilities.
+    dist = samples.sampled / samples.sampled.sum()
+    if (samples.sampled != samples.kept).any():
+        if simple_mc:
+            raise NameError("Simple mc needs a sample file without strata counts")
+        print "Using strata counts of the programs sampled"
+
+    # A dist file made by BF_enumerate has the exact probability of each
+    # stratum from the programs up to some length.  The samples are then
+    # only needed for the longer programs and for the fraction of the active
+    # programs that are short, so the strata probabilities are put together
+    # from these two parts.  Programs from a quota mode file are weighted
+    # by the number of programs sampled in their stratum for each one kept.
+    dist_filename = "./refmachines/samples/" + str(refm) + ".dist"
+    if isfile( dist_filename ) and not simple_mc:
+        print "Loading exact strata:    " + dist_filename
+        exact = zeros( (num_strata) )
+        file = open( dist_filename )
+        for line in file:
+            s, value = line.split()
+            if   s == "length": max_length = int(value)
+            elif s == "short":  pass
+            elif 0 < int(s) < num_strata: exact[ int(s) ] = float(value)
+        file.close()
+
+        kept = samples.kept
+        weights = zeros( (num_strata) )
+        weights[kept > 0] = dist[kept > 0]/kept[kept > 0]
+
+        short = 0.0
+        long_dist = zeros( (num_strata) )
+        for stratum, program in samples.programs():
+            if len( BF.canonical_program( program ) ) <= max_length:
+                short += weights[ stratum ]
+            else:
+                long_dist[ stratum ] += weights[ stratum ]
+
+        # a stratum with no samples can't be tested, so it has to be left out
+        missing = (exact > 0) & (kept == 0)
+        if missing.any():
+            print "Warning: no program samples for exact strata " \
+                  + str(list(missing.nonzero()[0]))
+            exact[missing] = 0.0
+
+        # with no active short programs in either part there is nothing to
+        # scale the exact strata by, so the sampled distribution is kept
+        if exact.sum() == 0.0 or short == 0.0:
+            print "Warning: no active programs up to length " + str(max_length) \
+                  + ", ignoring " + dist_filename
+        else:
+            dist = short * exact/exact.sum()
+            if long_dist.sum() > 0.0: dist += long_dist
+            dist /= dist.sum()
+
+    # Split the strata into sub-strata by the features of their programs, with
+    # the probability of each stratum divided between its sub-strata by the
+    # fraction of its programs in each.  The estimator then works with the
+    # sub-strata in place of the strata.
+    if substrata != []:
+        stratum_kept = samples.kept.astype( float )
+        parents = samples.refine( substrata )
+        share = ones( (samples.num_strata) )
+        kept = stratum_kept[parents] > 0
+        share[kept] = samples.kept[kept] / stratum_kept[parents][kept]
+        dist = dist[parents] * share
+        num_strata = samples.num_strata
+        print "Sub-strata split by:     " \
+              + ", ".join( [ ProgramCorpus.FEATURES[f] + ":" + str(b) for f, b in substrata ] )
+        print "Stratum of each sub-stratum:"
+        print parents[1:]
 
     print "Number of program samples:" + str(num_samples)
     if not simple_mc:
@@ -308,21 +1190,34 @@ def load_samples( refm, cluster_node, simple_mc ):
     return samples, dist
 
 
+# a TCP address of [host:]port as (host, port), where no host means this
+# machine only, so that serving other machines has to be asked for
+def address( arg ):
+    host, port = (["127.0.0.1"] + arg.split(":"))[-2:]
+    return (host, int(port))
+
+
 # print basic usage
 def usage():
     print "python AIQ -r reference_machine[,param1[,param2[...]]] " \
-        + "-a agent[,param1[,agent_param2[...]]] " \
+        + "-a agent[,param1[,agent_param2[...]]] [-a agent2[,...] ...] " \
         + "-d discount_rate [-s sample_size] [-l episode_length] " \
-        + "[-n cluster_node] [-t threads] [--log] [--simple_mc]" \
+        + "[-n cluster_node] [-t threads] [--log] [--simple_mc] [--profile] " \
+        + "[--seed seed] [--substrata feature[:bins][,feature[:bins]...]] " \
+        + "[--online [--report size1,size2,...]] [--ci half_width] [--time seconds] " \
+        + "[--checkpoint file [--resume]] [--serve [host:]port] [--authkey key]"
+    print "python AIQ --worker [host:]port --authkey key [-t threads]"
 
 
 # main function that just sets things up and then calls the sampler
-logging  = False
-log_file = None
+logging   = False
+log_file  = None
+profiling = False
+run_seed  = None
 
 def main():
 
-    global logging, log_file
+    global logging, log_file, profiling, run_seed
 
     print
     print "AIQ version 1.0"
@@ -331,22 +1226,33 @@ def main():
     # get the command line arguments
     try:
         opts, args = getopt.getopt(sys.argv[1:], "r:d:l:a:n:s:t:",
-                                   ["help", "log","simple_mc"])
+                                   ["help", "log","simple_mc","profile","seed=",
+                                    "substrata=","online","report=","ci=","time=",
+                                    "checkpoint=","resume","serve=","worker=","authkey="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
         sys.exit(2)
 
-    agent_str      = None
+    agent_strs     = []
     refm_str       = None
     disc_rate      = None
     episode_length = None
     cluster_node   = ""
     simple_mc      = False
     sample_size    = None
-    agent_params   = []
     refm_params    = []
     threads        = 0
+    substrata      = []
+    online         = False
+    reports        = None
+    target_ci      = None
+    time_limit     = None
+    checkpoint     = None
+    resume         = False
+    serve_address  = None
+    worker_address = None
+    authkey        = None
 
     # exit on no arguments
     if opts == []:
@@ -358,8 +1264,10 @@ def main():
         if opt == "-a":
             args = arg.split(",")
             agent_str = args.pop(0)
+            agent_params = []
             for a in args:
                 agent_params.append( float(a) )
+            agent_strs.append( (agent_str, agent_params) )
             
         elif opt == "-r": 
             args = arg.split(",")
@@ -373,18 +1281,57 @@ def main():
         elif opt == "-n": cluster_node       = "_"+arg
         elif opt == "-t": threads            = int(arg)
         elif opt == "--log":       logging   = True
+        elif opt == "--profile":   profiling = True
         elif opt == "--simple_mc": simple_mc = True
+        elif opt == "--seed":      run_seed  = int(arg)
+        elif opt == "--online":    online    = True
+        elif opt == "--ci":        target_ci  = float(arg)
+        elif opt == "--time":      time_limit = float(arg)
+        elif opt == "--checkpoint": checkpoint = arg
+        elif opt == "--resume":    resume    = True
+        elif opt == "--serve":     serve_address  = address( arg )
+        elif opt == "--worker":    worker_address = address( arg )
+        elif opt == "--authkey":   authkey   = arg
+        elif opt == "--report":
+            reports = [ int(r) for r in arg.split(",") ]
+        elif opt == "--substrata":
+            for split in arg.split(","):
+                feature, bins = (split + ":2").split(":")[:2]
+                if feature not in ProgramCorpus.FEATURES:
+                    raise NameError("Unknown program feature " + feature)
+                substrata.append( (ProgramCorpus.FEATURES.index(feature), int(bins)) )
         else:
             print "Unrecognised option"
             usage()
             sys.exit()
 
+    # a worker gets everything else from the coordinator
+    if worker_address != None:
+        if authkey == None: raise NameError("A worker needs the coordinator's --authkey")
+        run_worker( worker_address, authkey, threads )
+        return
+
     # basic parameter checks
-    if agent_str      == None: raise NameError("missing agent")
+    if agent_strs     == []:   raise NameError("missing agent")
     if refm_str       == None: raise NameError("missing reference machine")
     if disc_rate      == None: disc_rate = 1.0
     if logging and simple_mc:  raise NameError("Simple mc doesn't do logging")
-    if agent_str      == "Manual" and not simple_mc:
+    if substrata != [] and simple_mc:
+        raise NameError("Simple mc doesn't use strata")
+    if online and simple_mc:   raise NameError("Simple mc isn't adaptive")
+    if (target_ci != None or time_limit != None) and simple_mc:
+        raise NameError("Simple mc only stops at the sample size")
+    if reports != None and not online:
+        raise NameError("Report sizes are for the online estimator")
+    if checkpoint != None and (simple_mc or online):
+        raise NameError("Checkpoints only work with the staged stratified estimator")
+    if resume and checkpoint == None:
+        raise NameError("Resuming needs a checkpoint file")
+    if serve_address != None and simple_mc:
+        raise NameError("Simple mc doesn't use workers")
+    if len(agent_strs) > 1 and (simple_mc or online):
+        raise NameError("Several agents only work with the staged stratified estimator")
+    if "Manual" in [ agent_str for agent_str, agent_params in agent_strs ] and not simple_mc:
         raise NameError("Manual control only works with the simple mc sampler")
 
     # compute episode_length to have 95% of the infinite total in each episode
@@ -408,15 +1355,20 @@ def main():
     refm_call += " )"
     refm = eval( refm_call )
 
-    # construct agent
-    agent_call = agent_str + "." + agent_str + "( refm, " + str(disc_rate )
-    for param in agent_params: agent_call += ", " + str(param)
-    agent_call += " )"
-    agent = eval( agent_call )
+    # construct agents
+    agent_calls = []
+    for agent_str, agent_params in agent_strs:
+        agent_call = agent_str + "." + agent_str + "( refm, " + str(disc_rate )
+        for param in agent_params: agent_call += ", " + str(param)
+        agent_call += " )"
+        agent_calls.append( agent_call )
+    agents = [ eval( agent_call ) for agent_call in agent_calls ]
+    agent_call, agent = agent_calls[0], agents[0]
 
     # report settings
     print "Reference machine:       " + str(refm)
-    print "RL Agent:                " + str(agent)
+    for a in agents:
+        print "RL Agent:                " + str(a)
     print "Discount rate:           " + str(disc_rate)
     print "Episode length:          " + str(episode_length),
     if disc_rate != 1.0:
@@ -436,24 +1388,43 @@ def main():
 
     print "Sample size:             " + str(sample_size)
 
+    if run_seed != None:
+        print "Random seed:             " + str(run_seed)
+
     # load in program samples
-    samples, dist = load_samples( refm, cluster_node, simple_mc )
+    samples, dist = load_samples( refm, cluster_node, simple_mc, substrata )
 
     if sample_size == None:
-        sample_size = len(sample_data)
+        sample_size = len(samples)
         
     # The following is a crude check as we can still run out of samples in a
     # stratum depending on how the adaptive stratification decides to sample.
-    if sample_size > 2.0 * len(sample_data):
+    if sample_size > 2.0 * len(samples):
         print
         print "Error: More samples have been requested than are available in " \
               "the program sample file! (including fact that they are sampled twice)"
         sys.exit()
 
-    # report logging
-    if logging:
+    # load the checkpoint to carry on from
+    state = None
+    if resume:
+        state = load_checkpoint( checkpoint )
+        print "Resuming from:           " + checkpoint + " at the stage to " \
+              + str(int(max( state['N'], state['stage_N'] ))) + " samples"
+    elif checkpoint != None:
+        print "Checkpoint file:         " + checkpoint
+
+    # report logging, carrying on with the log of a resumed run, cut back to
+    # the results in the checkpoint
+    if logging and state != None and state['log'] != None and isfile( state['log'][0] ):
+        log_file_name, log_size = state['log']
+        log_file = open( log_file_name, 'r+' )
+        log_file.truncate( log_size )
+        log_file.seek( 0, 2 )
+        print "Logging to file:         " + log_file_name + " (continued)"
+    elif logging:
         log_file_name = "./log/" + str(refm) + "_" + str(disc_rate) + "_" \
-                        + str(episode_length) + "_" + str(agent) + cluster_node \
+                        + str(episode_length) + "_" + "+".join( map( str, agents ) ) + cluster_node \
                         + strftime("_%Y_%m%d_%H_%M_%S",localtime()) + ".log" 
         log_file = open( log_file_name, 'w' )
         for i in range( 1, len(dist) ):
@@ -462,17 +1433,48 @@ def main():
         log_file.flush()
         print "Logging to file:         " + log_file_name
 
+    # report profiling
+    if profiling:
+        if not isinstance( refm, BF.BF ):
+            raise NameError("Profiling only works with the BF reference machine")
+        profile_file_name = "./log/" + str(refm) + "_" + str(disc_rate) + "_" \
+                            + str(episode_length) + "_" + "+".join( map( str, agents ) ) + cluster_node \
+                            + strftime("_%Y_%m%d_%H_%M_%S",localtime()) + ".profile"
+        print "Profiling to file:       " + profile_file_name
+
     # run an estimation algorithm
     if simple_mc:
-        simple_mc_estimator( refm_call, agent_call, episode_length, disc_rate, sample_size )
+        profiles = simple_mc_estimator( refm_call, agent_call, episode_length,
+                                        disc_rate, samples, sample_size )
     else:
         # Kill agent and pass in its constructor call, this is because on Windows
         # some agents have trouble serialising which messes up the multiprocessing
         # library that Python uses.  Easier just to construct the agent inside the
         # method that gets called in parallel.
-        agent = None 
-        stratified_estimator( refm_call, agent_call, episode_length, disc_rate,
-                              samples, sample_size, dist, threads )
+        agent = agents = None 
+        if serve_address != None:
+            # the workers run whatever the coordinator sends them, so only
+            # ones with the key can connect, and without one a key is made up
+            if authkey == None: authkey = urandom( 16 ).encode( "hex" )
+            serve( serve_address, authkey, (refm_call, agent_calls, episode_length,
+                                            disc_rate, run_seed, profiling) )
+            print "Serving workers at:      " + serve_address[0] + ":" \
+                  + str(serve_address[1])
+            print "Worker authkey:          " + authkey
+            print
+        stopping = Stopping( target_ci, time_limit )
+        if online:
+            profiles = online_estimator( refm_call, agent_call, episode_length, disc_rate,
+                                         samples, sample_size, dist, threads, reports,
+                                         stopping )
+        else:
+            profiles = stratified_estimator( refm_call, agent_calls, episode_length,
+                                             disc_rate, samples, sample_size, dist, threads,
+                                             stopping, checkpoint, state )
+
+    # save the reference machine profiles
+    if profiling:
+        BF_profile.save_profiles( profiles, profile_file_name )
 
     # close log file
     if logging: log_file.close()
@@ -13,7 +13,8 @@ from os.path import basename
 
 
 
-def estimate( file, detailed ):
+# agent picks the results of one agent from a log of several, counting from 1
+def estimate( file, detailed, agent=1 ):
 
     # load in the strata distribution
     dist_line = ["0.0"]
@@ -32,7 +33,9 @@ def estimate( file, detailed ):
     # read in log file results
     num_samples = 0
     for result in file:
-        stamp, stratum, perf1, perf2 = result.split()
+        fields = result.split()
+        stratum = fields[1]
+        perf1, perf2 = fields[2*agent:2*agent+2]
         z = int(stratum)
         if True: #z > 10:
             Y[int(stratum)].append( (float(perf1),float(perf2)) )
@@ -91,7 +94,7 @@ def estimate( file, detailed ):
 
 # print basic usage
 def usage():
-    print "python ComputeFromLog [--full] log_file_name [log_file_name ...]" 
+    print "python ComputeFromLog [--full] [--agent n] log_file_name [log_file_name ...]" 
 
 
 # main function that just sets things up and then calls the sampler
@@ -103,6 +106,7 @@ def main():
     global logging, log_file
 
     detailed = False
+    agent    = 1
 
     print
     print "Compute AIQ from log file results, version 1.0"
@@ -118,13 +122,17 @@ def main():
         detailed = True
         sys.argv.pop(0)
 
+    if len(sys.argv) > 1 and sys.argv[0] == "--agent":
+        agent = int( sys.argv[1] )
+        sys.argv = sys.argv[2:]
+
     if len(sys.argv) == 0:
         usage()
         sys.exit()
 
     for file_name in sys.argv:
         file = open( file_name, 'r')
-        estimate( file, detailed )
+        estimate( file, detailed, agent )
         print ":" + basename(file_name)
         if detailed: print
         file.close()
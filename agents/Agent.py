@@ -10,8 +10,8 @@
 
 from scipy import zeros
 from scipy import exp
-from random import randrange
-from random import random
+
+from refmachines.RandomStream import RandomStream
 
 
 class Agent:
@@ -21,6 +21,7 @@ class Agent:
         self.num_actions = refm.getNumActions()
         self.sel_mode    = 0
         self.disc_rate   = disc_rate
+        self.rng         = RandomStream() # AIQ replaces this with a seeded stream
 
     def __str__( self ):
         raise NameError("You need to override Agent.__str__")
@@ -50,7 +51,7 @@ class Agent:
             elif q_values[a] == max_reward:
                 opt_move_count += 1
 
-        opt_move_sel = randrange(opt_move_count)
+        opt_move_sel = self.rng.randrange(opt_move_count)
         opt_move_count = 0
 
         for a in range(self.num_actions):
@@ -108,7 +109,7 @@ class Agent:
         if total == 0.0: total = 1e-20
 
         # finally do the random selection
-        rand = random()
+        rand = self.rng.random()
 
         for i in range(q_values.size):
             rand -= exp(rescaled_v[i])/total
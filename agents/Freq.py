@@ -14,9 +14,6 @@ from numpy import ones
 import  numpy as np
 
 
-from random import randint, randrange, random
-
-
 class Freq(Agent):
 
     def __init__( self, refm, disc_rate, epsilon ):
@@ -66,8 +63,8 @@ class Freq(Agent):
         # action selection
         if self.sel_mode == 0:
             # do an epsilon greedy selection
-            if random() < self.epsilon:
-                naction = randrange(self.num_actions)
+            if self.rng.random() < self.epsilon:
+                naction = self.rng.randrange(self.num_actions)
             else:
                 naction = opt_action
         else:
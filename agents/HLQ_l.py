@@ -8,8 +8,6 @@
 
 from Agent import Agent
 
-from random import randint, randrange, random
-
 from numpy  import zeros
 from numpy  import ones
 
@@ -87,8 +85,8 @@ class HLQ_l(Agent):
         # action selection
         if self.sel_mode == 0:
             # do an epsilon greedy selection
-            if random() < self.epsilon:
-                naction = randrange(self.num_actions)
+            if self.rng.random() < self.epsilon:
+                naction = self.rng.randrange(self.num_actions)
             else:
                 naction = opt_action
         else:
@@ -6,11 +6,8 @@
 
 import sys
 
-from random  import randint
 from Agent   import Agent
 
-import random
-
 MANUAL = 0
 RANDOM = 1
 SAME   = 2
@@ -25,7 +22,7 @@ class Manual(Agent):
             sys.exit()
 
         self.mode = MANUAL
-        self.last_val = 0
+        self.last_value = 0
             
 
     def __str__( self ):
@@ -37,6 +34,10 @@ class Manual(Agent):
         print "Reset!"
         print
 
+        # the agent is reused between runs, so go back to manual control
+        self.mode = MANUAL
+        self.last_value = 0
+
 
     def perceive( self, obs, reward ):
         print " obs = " + str(obs) + " reward = " + str(reward )
@@ -50,7 +51,7 @@ class Manual(Agent):
             else:
                 action = int(choice)
                 
-        if self.mode == RANDOM: action = random.randint(0, self.num_actions-1)
+        if self.mode == RANDOM: action = self.rng.randint(0, self.num_actions-1)
 
         if self.mode == SAME: action = self.last_value
 
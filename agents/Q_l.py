@@ -9,7 +9,6 @@
 from Agent import Agent
 from numpy import zeros, ones
 import numpy as np
-from random import randint, randrange, random
 import sys
 
 
@@ -81,8 +80,8 @@ class Q_l(Agent):
         # action selection
         if self.sel_mode == 0:
             # do an epsilon greedy selection
-            if random() < self.epsilon:
-                naction = randrange(self.num_actions)
+            if self.rng.random() < self.epsilon:
+                naction = self.rng.randrange(self.num_actions)
             else:
                 naction = opt_action
         else:
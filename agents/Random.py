@@ -5,7 +5,6 @@
 # Released under GNU GPLv3
 #
 
-from random  import randint
 from Agent   import Agent
 
 class Random(Agent):
@@ -20,6 +19,6 @@ class Random(Agent):
         pass
 
     def perceive( self, obs, reward ):
-        return randint( 0, self.num_actions-1 )
+        return self.rng.randint( 0, self.num_actions-1 )
 
     
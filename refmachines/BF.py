@@ -6,11 +6,15 @@
 # Released under GNU GPLv3
 
 
-import random
 import sys
 
 from ReferenceMachine import *
 
+import BF_jit
+import BF_memo
+import BF_profile
+from RandomStream import RandomStream
+
 from numpy import zeros, ones, array, linspace
 from scipy import stats, floor, sqrt
 from string import replace
@@ -18,12 +22,42 @@ from string import replace
 
 INSTRUCTIONS = ['<','>','+','-',',','.','[',']','#', '%' ]
 
+# opcodes for the compiled form of a program
+OP_LEFT, OP_RIGHT, OP_INC, OP_DEC, OP_READ, OP_WRITE, \
+         OP_OPEN, OP_CLOSE, OP_HALT, OP_RAND, OP_BAD = range(11)
+
+# extra opcodes produced by the peephole optimiser
+OP_ADD, OP_MOVE, OP_LOOP, OP_SCAN = range(11,15)
+
+OPCODES = { '<' : OP_LEFT,  '>' : OP_RIGHT, '+' : OP_INC,  '-' : OP_DEC,
+            ',' : OP_READ,  '.' : OP_WRITE, '[' : OP_OPEN, ']' : OP_CLOSE,
+            '#' : OP_HALT,  '%' : OP_RAND }
+
+
+# The state of a BF machine.  Rather than allocating the whole work tape
+# the list only covers the cells that have been visited, growing when the
+# pointer moves off it.  Cells 0 to high-1 are at the start of the list and
+# the negative cells low to -1 are at the end, so that the tape can still be
+# indexed directly with the work pointer.  Once the list reaches the full
+# tape length every pointer value is covered, as it is for a full tape.
+#
+# The input tape is a ring buffer so that loading an action doesn't have to
+# shift the history along.  Input cell i is input_tape[input_start+i], where
+# input_start runs from -1 down to -input_tape_len and then wraps around.
+
+class BFState(object):
+
+    __slots__ = ( 'work_tape', 'low', 'high', 'work_ptr',
+                  'input_tape', 'input_start', 'output_tape' )
+
 
 class BF(ReferenceMachine):
 
 
-    # create a new BF reference machine, default to a tape with 5 symbols
-    def __init__( self, num_symbols=5, obs_cells=1, reverse_output=0 ):
+    # create a new BF reference machine, default to a tape with 5 symbols.
+    # Setting jit to 1 compiles each program into Python code, see BF_jit.py,
+    # and setting memo to 1 remembers the results of cycles, see BF_memo.py
+    def __init__( self, num_symbols=5, obs_cells=1, reverse_output=0, jit=0, memo=0 ):
 
         self.num_symbols  = int(num_symbols)
         self.obs_cells    = int(obs_cells)
@@ -33,6 +67,8 @@ class BF(ReferenceMachine):
 
         self.obs_symbols = self.num_symbols
         self.reverse_output = (reverse_output == 1)
+        self.jit = (jit == 1)
+        self.memo = (memo == 1)
 
         # when num_symbols is odd the following gives us a reward balanced ref machine,
         # otherwise it's slightly unbalanced due to the loop exit condition favouring
@@ -47,13 +83,37 @@ class BF(ReferenceMachine):
         self.num_rewards = self.num_symbols**self.reward_cells
 
         self.work_tape_len   = 100000
+        self.init_tape_len   = 64 # part of the work tape allocated at the start
         self.input_tape_len  = 25 * self.action_cells  # contains action history
         self.output_tape_len = self.reward_cells + self.obs_cells # only this cycle
 
         self.max_steps   = 1000 # limit on how long to execute for in a single cycle
 
+        # a cycle that runs for more than repeat_steps is watched for the
+        # machine repeating a state, which means that it's stuck in a loop
+        self.repeat_steps = 100
+        self.repeat_cells = 1024 # unless the work tape is bigger than this
+        self.steps_saved  = 0    # steps skipped by finding repeated states
+
         self.program     = ""
 
+        self.code             = None # compiled form of the program
+        self.compiled_program = ""
+        self.cycle            = None # function for a cycle when using the jit
+        self.memo_table       = None # remembered cycles when using the memo cache
+        self.profile          = None # set to a BF_profile.Profile to profile cycles
+        self.rng              = RandomStream() # random numbers for the % instruction
+
+        # blank tapes to clear the machine's tapes with
+        x = self.mid_symbol
+        self.blank_work_tape   = [x]*min( self.init_tape_len, self.work_tape_len )
+        self.blank_input_tape  = [x]*self.input_tape_len
+        self.blank_output_tape = [x]*self.output_tape_len
+
+        self.state = BFState()
+        self.state.work_tape   = []
+        self.state.input_tape  = []
+        self.state.output_tape = []
         self.init_machine()
 
 
@@ -69,21 +129,29 @@ class BF(ReferenceMachine):
     # reset the ref machine before a new run and return the first reward and obs
     def reset( self, program="" ):
         self.program = program
+        self.load_code( program )
         self.init_machine()
         return (0.0, [self.mid_symbol]*self.obs_cells)
 
 
-    # initialise the machine by clearing the tape and reseting the pointers
+    # initialise the machine by clearing the tapes and reseting the pointers.
+    # The existing lists are cleared in place, and only the part of the work
+    # tape that has been visited needs clearing.
     def init_machine( self ):
 
-        x = self.mid_symbol
-        self.work_tape    = [x]*self.work_tape_len   # two way, read & write work tape
-        self.input_tape   = [x]*self.input_tape_len  # one way, read only input tape
-        self.output_tape  = [x]*self.output_tape_len # one way, write only output tape
+        state = self.state
+        state.work_tape[:]   = self.blank_work_tape   # two way, read & write work tape
+        state.input_tape[:]  = self.blank_input_tape  # one way, read only input tape
+        state.output_tape[:] = self.blank_output_tape # one way, write only output tape
+
+        tape_len = len(self.blank_work_tape)
+        state.high = tape_len/2
+        state.low  = state.high-tape_len
+        if tape_len == self.work_tape_len:
+            state.low, state.high = -tape_len, tape_len
 
-        self.work_ptr = 0
-        self.input_ptr = 0
-        self.output_ptr = 0
+        state.work_ptr    = 0
+        state.input_start = -1
 
 
     # entry point for an agent acting on the environment
@@ -99,136 +167,498 @@ class BF(ReferenceMachine):
         return reward, observations, steps
 
 
+    # run an agent for an episode, see ReferenceMachine.run_episode.  This
+    # does the same as calling act for each step, but with the machine's state
+    # and the reward for each output symbol held in locals.
+    def run_episode( self, agent, episode_length, disc_rate, rflip, program="" ):
+
+        reward, observations = self.reset( program )
+
+        perceive    = agent.perceive
+        state       = self.state
+        input_tape  = state.input_tape
+        output_tape = state.output_tape
+        input_len   = self.input_tape_len
+        num_actions = self.num_actions
+        max_steps   = self.max_steps
+        obs_cells   = self.obs_cells
+
+        mid_point = (self.num_symbols-1.0)/2.0
+        rewards = [ 100.0*(x-mid_point)/mid_point for x in range(self.num_symbols) ]
+
+        if self.reverse_output: reward_cell = obs_cells
+        else:                   reward_cell = 0
+
+        # the memo cache and profiling are handled by compute
+        if self.memo_table == None and self.profile == None:
+            run_cycle = self.run_cycle
+        else:
+            run_cycle = lambda: self.compute( program )
+
+        disc_reward = 0.0
+        discount    = 1.0
+
+        for i in range( episode_length ):
+            action = perceive( observations, rflip*reward )
+
+            if action < 0 or action >= num_actions:
+                raise NameError('invalid action! ' + str(action))
+
+            # load the action into the input tape, see load_input
+            start = state.input_start-1
+            if start < -input_len: start += input_len
+            state.input_start = start
+            input_tape[start] = action
+
+            if run_cycle() == max_steps: return (disc_reward, True)
+
+            reward = rewards[output_tape[reward_cell]]
+            if reward_cell == 0: observations = output_tape[1:]
+            else:                observations = output_tape[:obs_cells]
+
+            disc_reward += discount*rflip*reward
+            discount    *= disc_rate
+
+        return (disc_reward, False)
+
+
     #
     # all the remaining methods are internal methods specific to the BF ref machine
     #
 
 
-    # move the old data in the input tape along and load in the new data
+    # move the old data in the input tape along and load in the new data,
+    # which just means moving the start of the ring buffer back
     def load_input( self, input_data ):
 
         if len(input_data) != self.action_cells:
             raise NameError("Error: Input data to environment has wrong length")
 
-        self.input_tape[self.action_cells:] = self.input_tape[:-self.action_cells]
-        self.input_tape[:self.action_cells] = input_data
+        state = self.state
+        input_tape = state.input_tape
+
+        start = state.input_start-self.action_cells
+        if start < -self.input_tape_len: start += self.input_tape_len
+        state.input_start = start
+
+        for i in range(self.action_cells):
+            input_tape[start+i] = input_data[i]
 
 
     # read the output tape and convert into reward and action values
     def get_output( self ):
         mid_point = (self.num_symbols-1.0)/2.0
+        output_tape = self.state.output_tape
 
         if self.reverse_output:
-            return 100.0*(self.output_tape[self.obs_cells]-mid_point)/mid_point, \
-                   self.output_tape[:self.obs_cells]
+            return 100.0*(output_tape[self.obs_cells]-mid_point)/mid_point, \
+                   output_tape[:self.obs_cells]
         else:
-            return 100.0*(self.output_tape[0]-mid_point)/mid_point, \
-                   self.output_tape[1:]
+            return 100.0*(output_tape[0]-mid_point)/mid_point, \
+                   output_tape[1:]
 
 
-    # pull out the code between matching [ and ], keeping the last ] as the end of loop
-    def extract_loop( self, instructions ):
+    # the symbol on the output tape that gives the reward
+    def get_reward_symbol( self ):
+        if self.reverse_output:
+            return self.state.output_tape[self.obs_cells]
+        else:
+            return self.state.output_tape[0]
+
 
-        level = 1
-        i = 1
-        length = len(instructions)-1
+    # the pointer has moved off the allocated part of the work tape, or off
+    # the end of the whole tape, so wrap it around and grow the allocated part
+    # to cover it.  Returns the new pointer and allocated range.
+    def grow_tape( self, work_ptr ):
 
-        while level > 0 and i <= length:
-            if  instructions[i] == '[':
-                level += 1
-            elif instructions[i] == ']':
-                level -= 1
-            i += 1
+        state = self.state
+        tape = state.work_tape
+        tape_len = self.work_tape_len
 
-        return instructions[1:i]
+        if work_ptr < -tape_len or work_ptr >= tape_len:
+            work_ptr = 0 # pointer wrap around
 
+        if work_ptr >= state.high:
+            extra = min( max( work_ptr+1-state.high, state.high ), tape_len-len(tape) )
+            tape[state.high:state.high] = [self.mid_symbol]*extra
+            state.high += extra
 
-    # compute a block of instructions, either a whole program or a loop within a program
-    def compute( self, program, level = 0 ):
+        elif work_ptr < state.low:
+            extra = min( max( state.low-work_ptr, -state.low ), tape_len-len(tape) )
+            tape[state.high:state.high] = [self.mid_symbol]*extra
+            state.low -= extra
 
-        # only at start of computing the cycle, reset some stuff
-        if level == 0:
-            self.step = 0
-            self.input_ptr  = 0
-            self.output_ptr = 0
-            self.cycle_end = False
+        if len(tape) == tape_len:
+            state.low, state.high = -tape_len, tape_len
 
-        instr_ptr = 0
+        return work_ptr, state.low, state.high
 
-        while not self.cycle_end:
 
-            if self.step >= self.max_steps:
-                self.cycle_end = True
-                break
+    # compile a program into a flat list of opcodes along with a table that
+    # gives the position of the matching bracket for every [ and ].  Loops can
+    # then be run by jumping directly rather than by re-scanning the program.
+    # An unmatched [ skips to the end of the program, and running off the end
+    # of the program (or hitting an unmatched ]) halts the cycle like a #.
+    def compile_program( self, program ):
 
-            if self.output_ptr == self.output_tape_len:
-                self.cycle_end = True
-                break
+        ops   = [OPCODES.get(instr, OP_BAD) for instr in program]
+        jumps = [0]*len(ops)
+        stack = []
 
-            self.step += 1
-            instr = program[instr_ptr]
-
-            if   instr == '<':
-                self.work_ptr -= 1
-                if self.work_ptr < -self.work_tape_len:
-                    self.work_ptr = 0 # pointer wrap around
-
-            elif instr == '>':
-                self.work_ptr += 1
-                if self.work_ptr >= self.work_tape_len:
-                    self.work_ptr = 0 # pointer wrap around
-
-            elif instr == '+':
-                self.work_tape[self.work_ptr] += 1
-                if self.work_tape[self.work_ptr] >= self.num_symbols: # symbol wrap around
-                    self.work_tape[self.work_ptr] = 0
-
-            elif instr == '-':
-                self.work_tape[self.work_ptr] -= 1
-                if self.work_tape[self.work_ptr] < 0:                 # symbol wrap around
-                    self.work_tape[self.work_ptr] = self.num_symbols-1
-
-            elif instr == '.':
-                self.output_tape[self.output_ptr] = self.work_tape[self.work_ptr]
-                self.output_ptr += 1
-
-            elif instr == ',':
-                if self.input_ptr >= self.input_tape_len-1:
-                     # if reading past history end
-                    self.work_tape[self.work_ptr] = self.mid_symbol
+        for i in range(len(ops)):
+            if ops[i] == OP_OPEN:
+                stack.append( i )
+            elif ops[i] == OP_CLOSE:
+                if stack == []:
+                    ops[i] = OP_HALT
                 else:
-                    self.work_tape[self.work_ptr] = self.input_tape[self.input_ptr]
-                    self.input_ptr += 1
+                    j = stack.pop()
+                    jumps[i] = j
+                    jumps[j] = i
+
+        for j in stack:
+            jumps[j] = len(ops)-1 # skips to the sentinel
+
+        ops.append( OP_HALT ) # sentinel at the end of the program
+        jumps.append( 0 )
+
+        return ops, jumps
+
+
+    # peephole optimise compiled code.  Runs of + and - are fused into a single
+    # add, runs of < and > into a single move, and loops whose body only adds
+    # and moves are replaced by an operation that does the whole loop at once:
+    # OP_LOOP for loops that leave the pointer where it was, like [-] or [->+<],
+    # and OP_SCAN for loops that only move the pointer, like [>].
+    #
+    # The optimised operations sit at the same positions as the instructions
+    # they replace, so jumps are unchanged, and they charge the same number of
+    # steps.  If one can't be completed within max_steps, or might hit the
+    # pointer wrap around, compute falls back to the original code so that the
+    # machine stops in exactly the same state as it would have.
+    def optimise_code( self, ops, jumps ):
+
+        num_symbols = self.num_symbols
+        length = len(ops)
+        fast = list(ops)
+        args = [None]*length
+
+        # fuse runs of +- and <>
+        i = 0
+        while i < length:
+            j = i
+            if ops[i] == OP_INC or ops[i] == OP_DEC:
+                delta = 0
+                while j < length and (ops[j] == OP_INC or ops[j] == OP_DEC):
+                    if ops[j] == OP_INC: delta += 1
+                    else:                delta -= 1
+                    j += 1
+                if j-i > 1:
+                    fast[i] = OP_ADD
+                    args[i] = (j-i, delta % num_symbols)
+
+            elif ops[i] == OP_LEFT or ops[i] == OP_RIGHT:
+                move = low = high = 0
+                while j < length and (ops[j] == OP_LEFT or ops[j] == OP_RIGHT):
+                    if ops[j] == OP_RIGHT: move += 1
+                    else:                  move -= 1
+                    low  = min( low,  move )
+                    high = max( high, move )
+                    j += 1
+                if j-i > 1:
+                    fast[i] = OP_MOVE
+                    args[i] = (j-i, move, low, high)
+            i = max( j, i+1 )
+
+        # replace simple loops
+        for i in range(length):
+            if ops[i] != OP_OPEN or jumps[jumps[i]] != i: continue
+
+            body = ops[i+1:jumps[i]]
+            if [op for op in body if op not in (OP_INC,OP_DEC,OP_LEFT,OP_RIGHT)]:
+                continue
+
+            # work out what one pass of the loop body does
+            move = low = high = 0
+            adds = {}
+            for op in body:
+                if   op == OP_RIGHT: move += 1
+                elif op == OP_LEFT:  move -= 1
+                elif op == OP_INC:   adds[move] = adds.get(move,0) + 1
+                elif op == OP_DEC:   adds[move] = adds.get(move,0) - 1
+                low  = min( low,  move )
+                high = max( high, move )
+
+            loop_steps = len(body)+1 # includes the ] for each pass
+
+            if move == 0 and adds.get(0,0) % num_symbols != 0:
+                # number of passes needed for the loop cell to reach the mid
+                # symbol for each starting value, None if it never does
+                step_size = adds[0] % num_symbols
+                passes = [None]*num_symbols
+                for t in range(num_symbols):
+                    value = (self.mid_symbol - t*step_size) % num_symbols
+                    if passes[value] == None: passes[value] = t
+
+                others = [(offset, add % num_symbols) for offset, add \
+                          in adds.items() if offset != 0 and add % num_symbols != 0]
+
+                fast[i] = OP_LOOP
+                args[i] = (loop_steps, passes, others, low, high)
+
+            elif move != 0 and adds == {}:
+                fast[i] = OP_SCAN
+                args[i] = (loop_steps, move, low, high)
+
+        return fast, args
+
+
+    # get the compiled form of a program, only compiling it if it isn't the
+    # one that was compiled last time
+    def load_code( self, program ):
+
+        if program != self.compiled_program or self.code == None:
+            ops, jumps = self.compile_program( program )
+            fast, args = self.optimise_code( ops, jumps )
+            self.code = (ops, jumps, fast, args)
+            self.compiled_program = program
+
+            if self.jit:
+                self.cycle = BF_jit.get_function( self, program, self.code )
+            else:
+                self.cycle = None
+
+            if self.memo:
+                self.memo_table = BF_memo.get_table( self, program )
+            else:
+                self.memo_table = None
+
+        return self.code
 
-            elif instr == '%':
-                self.work_tape[self.work_ptr] = random.randrange(self.num_symbols)
 
-            elif instr == '[':
+    # compute one cycle of a program.  BF_sampler.py calls this directly with a
+    # program rather than via reset, so make sure the compiled code matches it.
+    def compute( self, program ):
 
-                # pull out loop instructions
-                loop = self.extract_loop( program[instr_ptr:] )
+        self.load_code( program )
 
-                # run the loop
-                while self.work_tape[self.work_ptr] != self.mid_symbol \
-                          and not self.cycle_end:
-                    self.compute( loop, level+1 )
+        if self.profile != None:
+            return BF_profile.run_cycle( self )
 
-                # jump past loop end including the ]
-                instr_ptr += len(loop)
+        table = self.memo_table
+        if table == None:
+            return self.run_cycle()
 
-            elif instr == ']':
-                return # exit running the loop
+        if not table.active or len(self.state.work_tape) > BF_memo.MAX_CELLS:
+            step = self.run_cycle()
+            if step >= BF_memo.MIN_STEPS: table.active = True
+            return step
 
-            elif instr == '#':
-                self.cycle_end = True
+        key = BF_memo.state_key( self, table )
+        cycle = table.cycles.get( key )
+
+        if cycle != None:
+            self.step = BF_memo.restore( self, cycle )
+            return self.step
+
+        step = self.run_cycle()
+        if step >= BF_memo.MIN_STEPS:
+            BF_memo.store( self, table, key, step )
+
+        return step
+
+
+    # run one cycle of the loaded program
+    def run_cycle( self ):
+
+        if self.cycle == None:
+            return self.interpret( 0, 0, 0, 0 )
+
+        state = self.state
+        instr_ptr, step, state.work_ptr, input_ptr, output_ptr = \
+            self.cycle( state.work_tape, state.work_ptr, state.low, state.high,
+                        state.input_tape, state.input_start, state.output_tape,
+                        self.rng.randrange )
+
+        if instr_ptr >= 0:
+            # the compiled code bailed out, so finish off the cycle
+            return self.interpret( instr_ptr, step, input_ptr, output_ptr )
+
+        self.step = step
+
+        return step
+
+
+    # interpret the compiled code for the loaded program, starting part way
+    # through a cycle at the given instruction with the given step count and
+    # pointers if the compiled code from the jit has bailed out
+    def interpret( self, instr_ptr, step, input_ptr, output_ptr ):
+
+        ops, jumps, code, args = self.code
+
+        # set up aliases, the machine state is kept in locals while running
+        state       = self.state
+        tape        = state.work_tape
+        input_tape  = state.input_tape
+        output_tape = state.output_tape
+        input_start = state.input_start
+        input_end   = self.input_tape_len-1
+        output_len  = self.output_tape_len
+        num_symbols = self.num_symbols
+        mid_symbol  = self.mid_symbol
+        max_steps   = self.max_steps
+        randrange   = self.rng.randrange
+
+        work_ptr   = state.work_ptr
+        tape_low   = state.low
+        tape_high  = state.high
+
+        # a snapshot of the state at the start of a loop, taken at steps that
+        # get further apart so that long repeats are eventually found
+        repeat_check  = self.repeat_steps
+        snapshot_ip   = -1 # no snapshot
+        snapshot_step = repeat_check
+        snapshot_gap  = 32
+
+        while step < max_steps and output_ptr != output_len:
+
+            step += 1
+            op = code[instr_ptr]
+
+            if op == OP_ADD:
+                count, add = args[instr_ptr]
+                if step+count-1 > max_steps:
+                    # run the original code one instruction at a time
+                    step -= 1
+                    code = ops
+                    continue
+                step += count-1
+                tape[work_ptr] = (tape[work_ptr] + add) % num_symbols
+                instr_ptr += count-1
+
+            elif op == OP_MOVE:
+                count, move, low, high = args[instr_ptr]
+                if step+count-1 > max_steps or work_ptr+low < tape_low \
+                       or work_ptr+high >= tape_high:
+                    step -= 1
+                    code = ops
+                    continue
+                step += count-1
+                work_ptr += move
+                instr_ptr += count-1
+
+            elif op == OP_INC:
+                tape[work_ptr] += 1
+                if tape[work_ptr] >= num_symbols: # symbol wrap around
+                    tape[work_ptr] = 0
+
+            elif op == OP_DEC:
+                tape[work_ptr] -= 1
+                if tape[work_ptr] < 0:            # symbol wrap around
+                    tape[work_ptr] = num_symbols-1
+
+            elif op == OP_LEFT:
+                work_ptr -= 1
+                if work_ptr < tape_low:
+                    work_ptr, tape_low, tape_high = self.grow_tape( work_ptr )
+
+            elif op == OP_RIGHT:
+                work_ptr += 1
+                if work_ptr >= tape_high:
+                    work_ptr, tape_low, tape_high = self.grow_tape( work_ptr )
+
+            elif op == OP_OPEN:
+                # skip past the matching ] if the loop isn't entered
+                if tape[work_ptr] == mid_symbol:
+                    instr_ptr = jumps[instr_ptr]
+
+            elif op == OP_CLOSE:
+                # jump back to the start of the loop body if still looping
+                if tape[work_ptr] != mid_symbol:
+                    instr_ptr = jumps[instr_ptr]
+
+                    if step >= repeat_check:
+                        # Look for the machine being in the same state as it
+                        # was in at the snapshot.  If it is then it will keep
+                        # repeating the steps since then, so skip as many
+                        # whole repeats as fit into the remaining steps.
+                        if instr_ptr == snapshot_ip and work_ptr == snapshot[0] \
+                               and input_ptr == snapshot[1] \
+                               and output_ptr == snapshot[2] and tape == snapshot[3]:
+                            period = step - snapshot[4]
+                            skip = (max_steps-step) - (max_steps-step) % period
+                            step += skip
+                            self.steps_saved += skip
+                            repeat_check = max_steps
+                        elif step >= snapshot_step:
+                            if len(tape) <= self.repeat_cells:
+                                snapshot_ip = instr_ptr
+                                snapshot = (work_ptr, input_ptr, output_ptr, tape[:], step)
+                            snapshot_step = step + snapshot_gap
+                            snapshot_gap *= 2
+
+            elif op == OP_READ:
+                if input_ptr >= input_end:
+                    # if reading past history end
+                    tape[work_ptr] = mid_symbol
+                else:
+                    tape[work_ptr] = input_tape[input_start+input_ptr]
+                    input_ptr += 1
+
+            elif op == OP_WRITE:
+                output_tape[output_ptr] = tape[work_ptr]
+                output_ptr += 1
+
+            elif op == OP_LOOP:
+                loop_steps, passes, others, low, high = args[instr_ptr]
+                t = passes[tape[work_ptr]]
+                if t == None or step+t*loop_steps > max_steps \
+                       or work_ptr+low < tape_low or work_ptr+high >= tape_high:
+                    step -= 1
+                    code = ops
+                    continue
+                if t > 0:
+                    step += t*loop_steps
+                    tape[work_ptr] = mid_symbol
+                    for offset, add in others:
+                        tape[work_ptr+offset] = \
+                            (tape[work_ptr+offset] + t*add) % num_symbols
+                instr_ptr = jumps[instr_ptr]
+
+            elif op == OP_SCAN:
+                loop_steps, move, low, high = args[instr_ptr]
+                passes = (max_steps-step) / loop_steps # passes we can afford
+                ptr = work_ptr
+                t = 0
+                while tape[ptr] != mid_symbol and t < passes \
+                          and ptr+low >= tape_low and ptr+high < tape_high:
+                    ptr += move
+                    t += 1
+                if tape[ptr] != mid_symbol:
+                    step -= 1
+                    code = ops
+                    continue
+                step += t*loop_steps
+                work_ptr = ptr
+                instr_ptr = jumps[instr_ptr]
+
+            elif op == OP_RAND:
+                tape[work_ptr] = randrange(num_symbols)
+                snapshot_ip = -1 # the state no longer determines what happens
+
+            elif op == OP_HALT:
+                break
 
             else:
-                print "Error: Unknown instruction ", instr
-                self.cycle_end = True
+                print "Error: Unknown instruction ", self.compiled_program[instr_ptr]
+                break
 
             instr_ptr += 1
 
-        return self.step
+        state.work_ptr = work_ptr
+        self.step = step
+
+        return step
 
 
 
@@ -239,22 +669,27 @@ class BF(ReferenceMachine):
         loop_depth = 0
 
         while loop_depth >= 0:
-            instr = random.choice(INSTRUCTIONS)
+            instr = INSTRUCTIONS[self.rng.randrange(len(INSTRUCTIONS))]
             if instr == '#': instr = ']'     # treat # as loop termination
             if instr == '[': loop_depth += 1
             if instr == ']': loop_depth -= 1
             if loop_depth < 0: instr = '#'   # if ] unmatched, end the program
             program += instr
 
-        # remove some simple pointless instruction combinations
+        return canonical_program( program )
+
+
+# remove some simple pointless instruction combinations from a program.  As
+# removing one can make another, like the +- in +<>-, keep going until no
+# adjacent cancelling pair is left.  This isn't a full normal form, as
+# equivalent programs can still differ, such as +>-< and >+<-.
+def canonical_program( program ):
+
+    while True:
+        old_program = program
         program = replace(program,'+-','')
         program = replace(program,'-+','')
         program = replace(program,'<>','')
         program = replace(program,'><','')
         program = replace(program,'[]','')
-
-        return program
-
-
-
-
+        if program == old_program: return program
@@ -0,0 +1,179 @@
+#
+# Static analyser for BF programs.  Tries to prove that a program is passive
+# or over time without running it on real inputs, so that these programs can
+# be rejected before the much slower dynamic classification in BF_sampler.py,
+# or before AIQ wastes a run on them.
+#
+# The analysis executes the program abstractly.  Cells hold either a known
+# symbol or an unknown value, which is what reading an action or a % gives.
+# As long as loops only test known cells the pointer and control flow are
+# the same for every possible sequence of actions, and when a loop tests an
+# unknown cell the analysis follows both branches.  The answers are only
+# ever proofs, so a program that is accepted still needs to be classified
+# by running it.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+import BF
+
+
+UNKNOWN = -1 # a cell that could hold any symbol
+NONMID  = -2 # a cell that could hold any symbol except the mid symbol
+
+MAX_PATHS    = 16 # give up when control flow splits into more paths than this
+BUDGET_STEPS = 20 # give up after this many times max_steps abstract steps
+
+# once a program can't be passive, give up looking for it going over time
+# after this many cycles
+OVERTIME_CYCLES = 25
+
+
+# Returns 0 if the program is proven to be passive, that is every run of it
+# gives the same rewards whatever the actions, and -1 if it is proven to go
+# over time within the given number of cycles whatever the actions are.
+# Otherwise returns None.  These match the classes that BF_sampler.test_class
+# would give the program.
+def analyse( refm, program, cycles=200 ):
+
+    # must be passive as it lacks read and/or write
+    if program.count('.') == 0 or program.count(',') == 0: return 0
+
+    return _analyse( refm, program, cycles )
+
+
+# Returns True if the program is proven to go over time within the given
+# number of cycles, whatever actions the agent takes
+def overtime( refm, program, cycles ):
+    return _analyse( refm, program, cycles ) == -1
+
+
+def _analyse( refm, program, cycles ):
+
+    ops, jumps = refm.compile_program( program )
+
+    num_symbols = refm.num_symbols
+    mid_symbol  = refm.mid_symbol
+    tape_len    = refm.work_tape_len
+    input_end   = refm.input_tape_len-1
+    output_len  = refm.output_tape_len
+    max_steps   = refm.max_steps
+
+    if refm.reverse_output: reward_cell = refm.obs_cells
+    else:                   reward_cell = 0
+
+    # the state of a path between cycles is the work pointer, the work tape
+    # as a dictionary of the cells that aren't mid and the output tape
+    paths   = [ (0, {}, (mid_symbol,)*output_len) ]
+    seen    = {}    # the cycle that each path state was first seen in
+    forked  = False # control flow has depended on an unknown cell
+    passive = True  # all rewards known, apart from the first few cycles
+    budget  = BUDGET_STEPS * max_steps
+
+    for cycle in range( 1, cycles+1 ):
+
+        if (forked or not passive) and cycle > OVERTIME_CYCLES: return None
+
+        # input cell i holds the action from i cycles back, or the mid
+        # symbol if there wasn't a cycle that far back
+        history = min( cycle, input_end )
+
+        next_paths = []
+        for path in paths:
+
+            # a path that repeats a state from the same point in the input
+            # history will repeat forever, so it never goes over time and
+            # any later rewards have already been seen
+            key = (history, path[0], tuple(sorted(path[1].items())), path[2])
+            if key in seen:
+                if not forked and passive and seen[key] > 4: return 0
+                return None
+            seen[key] = cycle
+
+            work_ptr, tape, output_tape = path
+            branches = [ (0, 0, work_ptr, 0, 0, dict(tape), list(output_tape)) ]
+
+            while branches != []:
+                instr_ptr, step, work_ptr, input_ptr, output_ptr, tape, output_tape \
+                    = branches.pop()
+
+                while step < max_steps and output_ptr != output_len:
+
+                    step += 1
+                    op = ops[instr_ptr]
+                    cell_ptr = work_ptr % tape_len
+                    cell = tape.get( cell_ptr, mid_symbol )
+
+                    if op == BF.OP_INC or op == BF.OP_DEC:
+                        if cell < 0:
+                            tape[cell_ptr] = UNKNOWN
+                        else:
+                            if op == BF.OP_INC: cell = (cell+1) % num_symbols
+                            else:               cell = (cell-1) % num_symbols
+                            if cell == mid_symbol: del tape[cell_ptr]
+                            else:                  tape[cell_ptr] = cell
+
+                    elif op == BF.OP_LEFT:
+                        work_ptr -= 1
+                        if work_ptr < -tape_len: work_ptr = 0 # pointer wrap around
+
+                    elif op == BF.OP_RIGHT:
+                        work_ptr += 1
+                        if work_ptr >= tape_len: work_ptr = 0 # pointer wrap around
+
+                    elif op == BF.OP_OPEN or op == BF.OP_CLOSE:
+                        if cell == UNKNOWN:
+                            # split, following the branch for a mid cell later
+                            forked = True
+                            if len(paths) + len(next_paths) + len(branches) >= MAX_PATHS:
+                                return None
+                            mid_tape = dict(tape)
+                            del mid_tape[cell_ptr]
+                            if op == BF.OP_OPEN: mid_ptr = jumps[instr_ptr]+1
+                            else:                mid_ptr = instr_ptr+1
+                            branches.append( (mid_ptr, step, work_ptr, input_ptr,
+                                              output_ptr, mid_tape, list(output_tape)) )
+                            cell = tape[cell_ptr] = NONMID
+                        if op == BF.OP_OPEN and cell == mid_symbol \
+                               or op == BF.OP_CLOSE and cell != mid_symbol:
+                            instr_ptr = jumps[instr_ptr]
+
+                    elif op == BF.OP_READ:
+                        if input_ptr >= input_end:
+                            tape.pop( cell_ptr, None ) # reading past history end
+                        else:
+                            if input_ptr < history: tape[cell_ptr] = UNKNOWN
+                            else:                   tape.pop( cell_ptr, None )
+                            input_ptr += 1
+
+                    elif op == BF.OP_WRITE:
+                        output_tape[output_ptr] = cell
+                        output_ptr += 1
+
+                    elif op == BF.OP_RAND:
+                        tape[cell_ptr] = UNKNOWN
+
+                    else:
+                        # a # or an unknown instruction halts
+                        break
+
+                    instr_ptr += 1
+
+                budget -= step
+                if budget < 0: return None
+
+                if step == max_steps: continue # this path went over time
+
+                # test_class ignores the rewards from the first 4 cycles
+                if cycle > 4 and output_tape[reward_cell] < 0: passive = False
+                next_paths.append( (work_ptr, tape, tuple(output_tape)) )
+
+        # every path has gone over time
+        if next_paths == []: return -1
+
+        paths = next_paths
+
+    if not forked and passive: return 0
+
+    return None
@@ -0,0 +1,285 @@
+#
+# Exact strata probabilities for short BF programs.  Rather than estimating
+# the probability of the short programs by sampling them, this enumerates
+# every program that BF.random_program can make up to a given length along
+# with the exact probability of making it, classifies each of them once,
+# and writes the probability of each stratum that comes from them to a .dist
+# file.  AIQ then only needs the sample file to estimate the part that comes
+# from the longer programs.
+#
+# random_program draws each instruction uniformly from the 10 in
+# BF.INSTRUCTIONS, with # treated as ], until a ] is unmatched, and then
+# removes cancelling pairs of instructions.  As the pairs don't overlap
+# in conflicting ways, removing them in any order gives the same program,
+# namely the one left by pushing the instructions onto a stack and popping
+# the top whenever the next instruction cancels it.  So a program w1...wn#
+# is made by pushing w1 to wn in turn, where before each push, and before the
+# end, there can be any number of excursions that push instructions and then
+# cancel them all again.  An excursion never includes a ], as nothing cancels
+# it, so they don't depend on the depth of loops.  The probability of the
+# program is then
+#
+#   P(w1...wn#) = 0.2 * product of P(wi) * product of 1/(1-L(top))
+#
+# where 0.2 is the chance of a ] or # ending the program, P(wi) is 0.1, or
+# 0.2 for ], and L(top) is the total probability of an excursion when top is
+# the instruction on top of the stack, for each of the n+1 stacks.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+from multiprocessing import Pool
+from itertools import imap
+from time import time
+import getopt, sys, random
+
+import BF
+import BF_analyser
+import BF_sampler
+from RandomStream import RandomStream
+
+
+# the instruction that cancels each instruction when it comes next
+CANCEL = { '+' : '-', '-' : '+', '<' : '>', '>' : '<', '[' : ']' }
+
+CHUNK_SIZE = 1000 # programs classified by each task
+
+
+# The probability of each instruction being drawn, as # is treated as ]
+def instruction_probabilities():
+    probs = {}
+    for instr in BF.INSTRUCTIONS:
+        if instr == '#': instr = ']'
+        probs[instr] = probs.get( instr, 0.0 ) + 1.0/len(BF.INSTRUCTIONS)
+    return probs
+
+
+# The total probability of an excursion for each instruction that can be on
+# top of the stack, with None for the empty stack.  An excursion pushes an
+# instruction c which is cancelled later, with the probability R(c) of that
+# being P(cancel c)/(1-L(c)), so L(top) is the sum of P(c)*R(c) over the c
+# that don't cancel top.  These equations are solved by iterating from zero.
+def excursion_probabilities():
+
+    probs = instruction_probabilities()
+    tops = [None] + probs.keys()
+
+    R = dict( [(c, 0.0) for c in CANCEL] )
+    while True:
+        L = {}
+        for top in tops:
+            L[top] = sum( [probs[c]*R[c] for c in CANCEL if CANCEL.get( top ) != c] )
+        new_R = dict( [(c, probs[CANCEL[c]]/(1.0-L[c])) for c in CANCEL] )
+        if max( [abs(new_R[c]-R[c]) for c in CANCEL] ) < 1e-15: return L
+        R = new_R
+
+
+# the exact probability that random_program makes the given program
+def program_probability( program ):
+
+    probs = instruction_probabilities()
+    L = excursion_probabilities()
+
+    p = 0.2/(1.0-L[None])
+    for instr in program[:-1]:
+        p *= probs[instr]/(1.0-L[instr])
+    return p
+
+
+# Generate all the programs that random_program can make with up to the
+# given number of instructions, including the final #, along with their
+# probabilities.  Programs are built an instruction at a time, skipping any
+# instruction that would cancel the previous one or close a loop that isn't
+# open, as random_program never makes these programs.
+def short_programs( max_length ):
+
+    probs = instruction_probabilities()
+    L = excursion_probabilities()
+    instrs = probs.keys()
+
+    # stack of (program so far, its probability, loop depth)
+    stack = [ ("", 1.0/(1.0-L[None]), 0) ]
+
+    while stack != []:
+        program, p, depth = stack.pop()
+
+        if depth == 0:
+            yield program + "#", p*0.2
+
+        if len(program)+2 > max_length: continue
+
+        for instr in instrs:
+            if program != "" and CANCEL.get( program[-1] ) == instr: continue
+            if instr == ']' and depth == 0: continue
+            if   instr == '[': new_depth = depth+1
+            elif instr == ']': new_depth = depth-1
+            else:              new_depth = depth
+            stack.append( (program+instr, p*probs[instr]/(1.0-L[instr]), new_depth) )
+
+
+# classify a chunk of programs, in the same way as BF_sampler does,
+# returning a list of their classes
+def classify_chunk( args ):
+
+    refm_call, seed, chunk, programs, use_cache = args
+
+    refm = eval( refm_call )
+    if use_cache: known = BF_sampler.known_classes
+    else:         known = None
+    classes = BF_sampler.ClassCache( known, RandomStream( seed, chunk, "trials" ) )
+
+    env_classes = []
+    for program in programs:
+        env_class = BF_analyser.analyse( refm, program )
+        if env_class == None: env_class = classes.classify( refm, program )
+        env_classes.append( env_class )
+
+    return env_classes, classes.new
+
+
+def usage():
+    print
+    print "Exact strata probabilities for short BF programs"
+    print
+    print "python BF_enumerate.py -l max_length -r ref_machine[,para1[,para2[...]]] " \
+          + "[-p processes] [--seed seed] [--no_cache]"
+    print
+
+
+def main():
+
+    print
+    print "BF short program enumerator"
+    print
+
+    max_length  = 0
+    refm_str    = None
+    refm_params = []
+    processes   = 1
+    seed        = None
+    use_cache   = True
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "l:r:p:", ["help", "seed=", "no_cache"])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    if opts == []:
+        usage()
+        sys.exit()
+
+    for opt, arg in opts:
+        if   opt == "-l": max_length = int(arg)
+        elif opt == "-r":
+            args = arg.split(",")
+            refm_str = args.pop(0)
+            for a in args:
+                refm_params.append( float(a) )
+        elif opt == "-p":         processes = int(arg)
+        elif opt == "--seed":     seed      = int(arg)
+        elif opt == "--no_cache": use_cache = False
+        else:
+            print "Unrecognised option"
+            usage()
+            sys.exit()
+
+    if max_length < 1:
+        print "Error: No maximum program length set"
+        sys.exit()
+
+    # an active program needs a read, a write and the final #
+    if max_length < 3:
+        print "Error: No programs of up to " + str(max_length) \
+              + " instructions are active, use -l 3 or more"
+        sys.exit()
+
+    if refm_str != "BF":
+        print "Can only handle BF reference machine at the moment!"
+        sys.exit()
+
+    refm_call = refm_str + "." + refm_str + "("
+    if len(refm_params) > 0: refm_call += str(int(refm_params.pop(0)))
+    for param in refm_params: refm_call += "," + str(int(param))
+    refm_call += ")"
+
+    machine = str( eval( refm_call ) )
+    file_name  = "./samples/" + machine + ".dist"
+    cache_name = "./samples/" + machine + ".classes"
+
+    if seed == None: seed = random.SystemRandom().randrange( 2**31 )
+
+    if use_cache:
+        BF_sampler.known_classes, lines = BF_sampler.load_classes( cache_name, -1 )
+
+    print "Output filename: " + file_name
+    print "Random seed:     " + str(seed)
+    print
+
+    start = time()
+
+    # programs without both a read and a write are passive, so only the
+    # rest need to be classified
+    mass = {}
+    short_mass = 0.0
+    programs = []
+    probabilities = []
+    for program, p in short_programs( max_length ):
+        short_mass += p
+        if program.count('.') == 0 or program.count(',') == 0:
+            mass[0] = mass.get( 0, 0.0 ) + p
+        else:
+            programs.append( program )
+            probabilities.append( p )
+
+    print "Programs of up to %d instructions have probability %.6f" \
+          % (max_length, short_mass)
+    print "Classifying %d programs that have reads and writes" % len(programs)
+
+    tasks = [ (refm_call, seed, i/CHUNK_SIZE, programs[i:i+CHUNK_SIZE], use_cache) \
+              for i in range( 0, len(programs), CHUNK_SIZE ) ]
+
+    if processes == 1: pool = None
+    else:              pool = Pool( processes )
+
+    if pool == None: results = imap( classify_chunk, tasks )
+    else:            results = pool.imap( classify_chunk, tasks )
+
+    i = 0
+    new_classes = {}
+    for env_classes, chunk_classes in results:
+        for env_class in env_classes:
+            mass[env_class] = mass.get( env_class, 0.0 ) + probabilities[i]
+            i += 1
+        new_classes.update( chunk_classes )
+        print " % 8d programs classified" % i
+
+    if pool != None:
+        pool.close()
+        pool.join()
+
+    if use_cache:
+        new_classes = dict( [ (program, s) for program, s in new_classes.items()
+                              if program not in BF_sampler.known_classes ] )
+        BF_sampler.save_classes( cache_name, new_classes )
+
+    # The .dist file gives the maximum length, the total probability of the
+    # programs up to that length and the part of it in each class
+    dist_file = open( file_name, 'w' )
+    dist_file.write( "length " + str(max_length) + "\n" )
+    dist_file.write( "short " + repr(short_mass) + "\n" )
+    for s in range( -1, BF_sampler.STRATA ):
+        dist_file.write( str(s) + " " + repr(mass.get( s, 0.0 )) + "\n" )
+    dist_file.close()
+
+    print
+    print "Finished in %.1f seconds" % (time()-start)
+    print "Probability of each class from the short programs:"
+    for s in range( -1, BF_sampler.STRATA ):
+        print " % 3d  %.6f" % (s, mass.get( s, 0.0 ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#
+# Just in time compiler for the BF reference machine.  Each program is
+# translated into a specialised Python function that runs one cycle of the
+# program, which is much faster than interpreting it one instruction at a
+# time.  Compiled functions are kept in a bounded LRU cache so that repeated
+# runs of a program, like the two antithetic runs in AIQ, only compile once.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+from collections import OrderedDict
+
+import BF
+
+
+CACHE_SIZE = 500  # number of compiled programs to keep
+
+cache = OrderedDict()
+
+
+# get the compiled cycle function for the program that the machine has loaded,
+# or None if the program can't be compiled, in which case the interpreter
+# should be used instead
+def get_function( refm, program, code ):
+
+    key = ( program, refm.num_symbols, refm.mid_symbol, refm.input_tape_len,
+            refm.output_tape_len, refm.max_steps )
+
+    function = cache.pop( key, False )
+
+    if function == False:
+        function = compile_function( refm, program, code )
+
+    cache[key] = function  # put it at the most recently used end
+    if len(cache) > CACHE_SIZE:
+        cache.popitem( last=False )
+
+    return function
+
+
+# Translate a compiled program into the source for a Python function
+# that runs one cycle of it:
+#
+#   cycle( tape, ptr, low, high, input_tape, input_start, output_tape, randrange )
+#
+# where low and high give the allocated part of the work tape (see BFState).
+#
+# The function returns ( resume, step, ptr, input_ptr, output_ptr ).  If resume
+# is -1 the cycle is complete.  Otherwise the function has bailed out before
+# the instruction at position resume, with the step count and pointers as they
+# would be at that point, and the interpreter should finish the cycle.
+#
+# Straight line code is grouped into blocks, and the steps for a whole block
+# are charged at the start of it.  If there aren't enough steps left to finish
+# a block the function bails out so that the interpreter can stop at exactly
+# the right instruction.  Blocks end at a loop, a . (as the output tape might
+# be full) and a #.  The same happens for the cases the optimised code also
+# leaves to the interpreter, namely the pointer moving off the allocated part
+# of the work tape, loops that run out of steps part way through and unknown
+# instructions.
+def generate_source( refm, code ):
+
+    ops, jumps, fast, args = code
+
+    N          = refm.num_symbols
+    MID        = refm.mid_symbol
+    INPUT_END  = refm.input_tape_len-1
+    OUTPUT_LEN = refm.output_tape_len
+    MAX        = refm.max_steps
+
+    lines = [ "def cycle( tape, ptr, low, high, input_tape, input_start, "
+              + "output_tape, randrange ):",
+              "    step = 0",
+              "    input_ptr = 0",
+              "    output_ptr = 0" ]
+
+    state = "step, ptr, input_ptr, output_ptr)"
+    done  = "return (-1, " + state
+
+    def bail( indent, instr_ptr, refund=0 ):
+        if refund == 0:
+            return indent + "return (%d, %s" % (instr_ptr, state)
+        return indent + "return (%d, step-%d, ptr, input_ptr, output_ptr)" \
+               % (instr_ptr, refund)
+
+    # emit a block of straight line code, each item is a position in the
+    # code and the number of steps it takes
+    def emit_block( block, indent ):
+
+        if block == []: return
+
+        cost = sum( [steps for instr_ptr, steps in block] )
+        lines.append( indent + "if step > %d: " % (MAX-cost) \
+                      + bail( "", block[0][0] ).strip() )
+        lines.append( indent + "step += %d" % cost )
+
+        charged = 0
+        for instr_ptr, steps in block:
+            refund = cost-charged
+            op = fast[instr_ptr]
+
+            if op == BF.OP_INC or op == BF.OP_DEC or op == BF.OP_ADD:
+                if   op == BF.OP_INC: add = 1
+                elif op == BF.OP_DEC: add = N-1
+                else:                 add = args[instr_ptr][1]
+                lines.append( indent + "tape[ptr] = (tape[ptr] + %d) %% %d" \
+                              % (add, N) )
+
+            elif op == BF.OP_LEFT or op == BF.OP_RIGHT or op == BF.OP_MOVE:
+                if   op == BF.OP_LEFT:  move, low, high = -1, -1, 0
+                elif op == BF.OP_RIGHT: move, low, high =  1,  0, 1
+                else:                   count, move, low, high = args[instr_ptr]
+                if low < 0:
+                    lines.append( indent + "if ptr < low+%d: " % -low \
+                                  + bail( "", instr_ptr, refund ).strip() )
+                if high > 0:
+                    lines.append( indent + "if ptr >= high-%d: " % high \
+                                  + bail( "", instr_ptr, refund ).strip() )
+                lines.append( indent + "ptr += %d" % move )
+
+            elif op == BF.OP_READ:
+                lines.append( indent + "if input_ptr < %d:" % INPUT_END )
+                lines.append( indent + "    tape[ptr] = input_tape[input_start+input_ptr]" )
+                lines.append( indent + "    input_ptr += 1" )
+                lines.append( indent + "else:" )
+                lines.append( indent + "    tape[ptr] = %d" % MID )
+
+            elif op == BF.OP_WRITE:
+                lines.append( indent + "output_tape[output_ptr] = tape[ptr]" )
+                lines.append( indent + "output_ptr += 1" )
+
+            elif op == BF.OP_RAND:
+                lines.append( indent + "tape[ptr] = randrange(%d)" % N )
+
+            # [, ] and # are handled by the code around the block
+
+            charged += steps
+
+    # emit the code between two positions in the compiled program, the end
+    # of a loop body includes the ] at the end position
+    def emit_code( start, end, indent ):
+
+        block = []
+        instr_ptr = start
+
+        while instr_ptr < end:
+            op = fast[instr_ptr]
+
+            if op == BF.OP_OPEN and jumps[jumps[instr_ptr]] != instr_ptr:
+                # unmatched [, leave it to the interpreter
+                emit_block( block, indent )
+                block = []
+                lines.append( bail( indent, instr_ptr ) )
+                instr_ptr = len(fast)
+
+            elif op == BF.OP_OPEN:
+                block.append( (instr_ptr, 1) )
+                emit_block( block, indent )
+                block = []
+                lines.append( indent + "while tape[ptr] != %d:" % MID )
+                emit_code( instr_ptr+1, jumps[instr_ptr], indent + "    " )
+                instr_ptr = jumps[instr_ptr]+1
+
+            elif op == BF.OP_LOOP:
+                block.append( (instr_ptr, 1) )
+                emit_block( block, indent )
+                block = []
+                loop_steps, passes, others, low, high = args[instr_ptr]
+                lines.append( indent + "t = passes_%d[tape[ptr]]" % instr_ptr )
+                lines.append( indent + "if t == None or step > %d-t*%d " \
+                              % (MAX, loop_steps) \
+                              + "or ptr < low+%d or ptr >= high-%d: " \
+                              % (-low, high) \
+                              + bail( "", instr_ptr, 1 ).strip() )
+                lines.append( indent + "if t > 0:" )
+                lines.append( indent + "    step += t*%d" % loop_steps )
+                lines.append( indent + "    tape[ptr] = %d" % MID )
+                for offset, add in others:
+                    lines.append( indent + "    tape[ptr+%d] = " % offset \
+                                  + "(tape[ptr+%d] + t*%d) %% %d" \
+                                  % (offset, add, N) )
+                constants["passes_%d" % instr_ptr] = tuple(passes)
+                instr_ptr = jumps[instr_ptr]+1
+
+            elif op == BF.OP_SCAN:
+                block.append( (instr_ptr, 1) )
+                emit_block( block, indent )
+                block = []
+                loop_steps, move, low, high = args[instr_ptr]
+                lines.append( indent + "if tape[ptr] != %d:" % MID )
+                lines.append( indent + "    p = ptr" )
+                lines.append( indent + "    passes = (%d-step) / %d" \
+                              % (MAX, loop_steps) )
+                lines.append( indent + "    while tape[p] != %d and passes > 0" \
+                              % MID + " and low+%d <= p < high-%d:" \
+                              % (-low, high) )
+                lines.append( indent + "        p += %d" % move )
+                lines.append( indent + "        passes -= 1" )
+                lines.append( indent + "    if tape[p] != %d: " % MID \
+                              + bail( "", instr_ptr, 1 ).strip() )
+                lines.append( indent + "    step += (ptr-p)/%d*%d" \
+                              % (-move, loop_steps) )
+                lines.append( indent + "    ptr = p" )
+                instr_ptr = jumps[instr_ptr]+1
+
+            elif op == BF.OP_WRITE:
+                block.append( (instr_ptr, 1) )
+                emit_block( block, indent )
+                block = []
+                lines.append( indent + "if output_ptr == %d: " % OUTPUT_LEN \
+                              + done )
+                instr_ptr += 1
+
+            elif op == BF.OP_HALT:
+                block.append( (instr_ptr, 1) )
+                emit_block( block, indent )
+                block = []
+                lines.append( indent + done )
+                instr_ptr += 1
+
+            elif op == BF.OP_BAD:
+                # let the interpreter report it
+                emit_block( block, indent )
+                block = []
+                lines.append( bail( indent, instr_ptr ) )
+                instr_ptr += 1
+
+            elif op == BF.OP_ADD or op == BF.OP_MOVE:
+                block.append( (instr_ptr, args[instr_ptr][0]) )
+                instr_ptr += args[instr_ptr][0]
+
+            else:
+                block.append( (instr_ptr, 1) )
+                instr_ptr += 1
+
+        # the ] at the end of a loop body, the test is done by the while
+        if end < len(fast) and fast[end] == BF.OP_CLOSE:
+            block.append( (end, 1) )
+        emit_block( block, indent )
+
+    constants = {}
+    emit_code( 0, len(fast), "    " )
+    lines.append( "    " + done )
+
+    return "\n".join( lines ) + "\n", constants
+
+
+# compile a program into a cycle function, returns None if it can't be done,
+# for example when loops are nested too deeply for Python
+def compile_function( refm, program, code ):
+
+    source, constants = generate_source( refm, code )
+
+    try:
+        exec compile( source, "<BF " + program + ">", "exec" ) in constants
+    except (SyntaxError, MemoryError, RuntimeError):
+        return None
+
+    return constants["cycle"]
+
@@ -0,0 +1,155 @@
+#
+# Memo cache for the BF reference machine.  For a program without the %
+# instruction a cycle is a function of the machine's state, so the result of
+# a cycle can be remembered and replayed the next time the machine is in the
+# same state.  Many environments cycle through a small set of states, which
+# makes this a big saving for programs that take many steps per cycle.
+#
+# The cache is kept at the module level so that it is shared by all the
+# machines in a process, such as the two antithetic runs of a program in AIQ.
+# It holds a table of cycles for each program.  The size of the cache is
+# counted in the tape cells held by its cycles, as the tapes make up most of
+# its memory.  When it gets too big the tables of the least recently used
+# programs are thrown away, and then the oldest cycles of the program that
+# is running.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+from collections import OrderedDict
+
+
+CACHE_CELLS = 2**22 # total tape cells to remember across all programs, about 32MB
+ENTRY_CELLS = 16    # cells counted for the tuples and dict entry of each cycle,
+                    # and for each table
+MIN_STEPS   = 100   # only remember cycles that take at least this many steps
+MAX_CELLS   = 1024  # don't remember states once the work tape is bigger than this
+
+cache = OrderedDict()
+cache_cells = 0
+
+
+class MemoTable(object):
+
+    __slots__ = ( 'key', 'cycles', 'cells', 'input_cells', 'active' )
+
+
+# get the table of remembered cycles for a program, or None if the program
+# can't be memoised.  Cycles are only looked up and remembered once the
+# program has had a cycle long enough to be worth it, as making the key for
+# a state costs about as much as running a short cycle.
+def get_table( refm, program ):
+
+    global cache_cells
+
+    if '%' in program: return None
+
+    key = ( program, refm.num_symbols, refm.work_tape_len, refm.input_tape_len,
+            refm.output_tape_len, refm.max_steps )
+
+    table = cache.pop( key, None )
+
+    if table == None:
+        table = MemoTable()
+        table.key = key
+        table.cycles = OrderedDict() # oldest cycles first
+        table.cells = ENTRY_CELLS
+        table.input_cells = input_cells( refm, program )
+        table.active = False # set once the program has had a long cycle
+        cache_cells += table.cells
+
+    cache[key] = table  # put it at the most recently used end
+    shrink( table )
+
+    return table
+
+
+# the number of cells of the input tape that a cycle of the program can
+# read.  Outside of loops each , can only run once in a cycle.
+def input_cells( refm, program ):
+
+    input_end = refm.input_tape_len-1
+
+    depth = 0
+    for instr in program:
+        if   instr == '[': depth += 1
+        elif instr == ']' and depth > 0: depth -= 1
+        elif instr == ',' and depth > 0: return input_end
+
+    return min( program.count(','), input_end )
+
+
+# the key for the current state of the machine, which is everything that
+# the next cycle can depend on
+def state_key( refm, table ):
+
+    state = refm.state
+    input_tape  = state.input_tape
+    input_start = state.input_start
+
+    return ( tuple(state.work_tape), state.high, state.work_ptr,
+             tuple([input_tape[input_start+i] for i in range(table.input_cells)]),
+             tuple(state.output_tape) )
+
+
+# the number of cells counted for a remembered cycle
+def cycle_cells( key, cycle ):
+
+    return len(key[0]) + len(key[3]) + len(key[4]) \
+           + len(cycle[0]) + len(cycle[4]) + ENTRY_CELLS
+
+
+# remember the cycle that took the machine from the state with the given key
+# to its current state
+def store( refm, table, key, step ):
+
+    global cache_cells
+
+    if cache.get( table.key ) is not table: return # the table has been thrown away
+
+    state = refm.state
+    cycle = ( tuple(state.work_tape), state.low, state.high,
+              state.work_ptr, tuple(state.output_tape), step )
+    table.cycles[key] = cycle
+    cells = cycle_cells( key, cycle )
+    table.cells += cells
+    cache_cells += cells
+
+    shrink( table )
+
+
+# throw away tables and cycles until the cache is within its size, keeping
+# the table that is being used
+def shrink( table ):
+
+    global cache_cells
+
+    while cache_cells > CACHE_CELLS:
+        if len(cache) > 1:
+            old_key, old_table = cache.popitem( last=False )
+            if old_table is table:
+                # keep the table that is being used, as the most recently used
+                cache[old_key] = table
+            else:
+                cache_cells -= old_table.cells
+        else:
+            # only the table that is being used is left, so throw away its
+            # oldest cycles
+            if len(table.cycles) == 0: break
+            old_key, old_cycle = table.cycles.popitem( last=False )
+            cells = cycle_cells( old_key, old_cycle )
+            table.cells -= cells
+            cache_cells -= cells
+
+
+# put the machine into the state at the end of a remembered cycle, and
+# return the number of steps the cycle took
+def restore( refm, cycle ):
+
+    state = refm.state
+    work_tape, state.low, state.high, state.work_ptr, output_tape, step = cycle
+    state.work_tape[:]   = work_tape
+    state.output_tape[:] = output_tape
+
+    return step
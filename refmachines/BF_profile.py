@@ -0,0 +1,195 @@
+#
+# Profiling for the BF reference machine.  When a machine has a Profile the
+# cycles are run by a separate interpreter that counts the instructions it
+# runs, the number of steps in each cycle and how each cycle ended, so that
+# the normal interpreter doesn't pay anything for it.  Profiles can be merged,
+# for example to combine the results from different worker processes or all
+# the programs in a stratum, and saved as JSON.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+import json
+
+import BF
+
+
+# names for the plain opcodes in the histogram, in the order of the opcodes
+# in BF.py, with ? for unknown instructions
+OPCODE_NAMES = [ '<', '>', '+', '-', ',', '.', '[', ']', '#', '%', '?' ]
+
+# the ways that a cycle can end, a cycle that uses all max_steps is over time
+ENDS = [ 'halt', 'output', 'overtime', 'error' ]
+
+
+class Profile:
+
+    def __init__( self ):
+        self.cycles  = 0
+        self.opcodes = dict( [(name, 0) for name in OPCODE_NAMES] )
+        self.steps   = {} # number of cycles that took each number of steps
+        self.ends    = dict( [(end, 0) for end in ENDS] )
+
+    def __str__( self ):
+        return "Profile(" + str(self.cycles) + " cycles, " \
+               + "%.1f" % self.mean_steps() + " mean steps)"
+
+    # the mean number of steps per cycle
+    def mean_steps( self ):
+        if self.cycles == 0: return 0.0
+        total = sum( [steps*count for steps, count in self.steps.items()] )
+        return float(total) / self.cycles
+
+    # add the counts from another profile into this one
+    def merge( self, other ):
+        self.cycles += other.cycles
+        for name, count in other.opcodes.items():
+            self.opcodes[name] = self.opcodes.get( name, 0 ) + count
+        for steps, count in other.steps.items():
+            self.steps[steps] = self.steps.get( steps, 0 ) + count
+        for end, count in other.ends.items():
+            self.ends[end] = self.ends.get( end, 0 ) + count
+        return self
+
+    # convert to and from a dictionary that can be written as JSON
+    def to_dict( self ):
+        return { 'cycles'  : self.cycles,
+                 'opcodes' : self.opcodes,
+                 'steps'   : dict( [(str(s), c) for s, c in self.steps.items()] ),
+                 'ends'    : self.ends }
+
+    def from_dict( self, data ):
+        self.cycles  = data['cycles']
+        self.opcodes = dict( data['opcodes'] )
+        self.steps   = dict( [(int(s), c) for s, c in data['steps'].items()] )
+        self.ends    = dict( data['ends'] )
+        return self
+
+
+# save groups of profiles as JSON, for example
+#   { 'strata' : { 1 : profile, ... }, 'programs' : { program : profile, ... } }
+def save_profiles( profiles, file_name ):
+    data = {}
+    for group, members in profiles.items():
+        data[group] = dict( [(str(key), profile.to_dict()) \
+                             for key, profile in members.items()] )
+    file = open( file_name, 'w' )
+    json.dump( data, file, indent=1, sort_keys=True )
+    file.close()
+
+
+# load groups of profiles saved by save_profiles, the keys come back as strings
+def load_profiles( file_name ):
+    file = open( file_name )
+    data = json.load( file )
+    file.close()
+    profiles = {}
+    for group, members in data.items():
+        profiles[group] = dict( [(key, Profile().from_dict(d)) \
+                                 for key, d in members.items()] )
+    return profiles
+
+
+# run one cycle of the program loaded into the machine, recording it in the
+# machine's profile.  This follows BF.interpret, but only uses the plain
+# opcodes so that the histogram counts the program's own instructions.
+def run_cycle( refm ):
+
+    ops, jumps, code, args = refm.code
+
+    state       = refm.state
+    tape        = state.work_tape
+    input_tape  = state.input_tape
+    output_tape = state.output_tape
+    input_start = state.input_start
+    input_end   = refm.input_tape_len-1
+    output_len  = refm.output_tape_len
+    num_symbols = refm.num_symbols
+    mid_symbol  = refm.mid_symbol
+    max_steps   = refm.max_steps
+
+    work_ptr   = state.work_ptr
+    tape_low   = state.low
+    tape_high  = state.high
+    instr_ptr  = 0
+    step       = 0
+    input_ptr  = 0
+    output_ptr = 0
+
+    counts = [0]*len(OPCODE_NAMES)
+    end = 'overtime'
+
+    while step < max_steps:
+
+        if output_ptr == output_len:
+            end = 'output'
+            break
+
+        step += 1
+        op = ops[instr_ptr]
+        counts[op] += 1
+
+        if op == BF.OP_INC:
+            tape[work_ptr] = (tape[work_ptr]+1) % num_symbols
+
+        elif op == BF.OP_DEC:
+            tape[work_ptr] = (tape[work_ptr]-1) % num_symbols
+
+        elif op == BF.OP_LEFT:
+            work_ptr -= 1
+            if work_ptr < tape_low:
+                work_ptr, tape_low, tape_high = refm.grow_tape( work_ptr )
+
+        elif op == BF.OP_RIGHT:
+            work_ptr += 1
+            if work_ptr >= tape_high:
+                work_ptr, tape_low, tape_high = refm.grow_tape( work_ptr )
+
+        elif op == BF.OP_OPEN:
+            if tape[work_ptr] == mid_symbol:
+                instr_ptr = jumps[instr_ptr]
+
+        elif op == BF.OP_CLOSE:
+            if tape[work_ptr] != mid_symbol:
+                instr_ptr = jumps[instr_ptr]
+
+        elif op == BF.OP_READ:
+            if input_ptr >= input_end:
+                tape[work_ptr] = mid_symbol
+            else:
+                tape[work_ptr] = input_tape[input_start+input_ptr]
+                input_ptr += 1
+
+        elif op == BF.OP_WRITE:
+            output_tape[output_ptr] = tape[work_ptr]
+            output_ptr += 1
+
+        elif op == BF.OP_RAND:
+            tape[work_ptr] = refm.rng.randrange(num_symbols)
+
+        elif op == BF.OP_HALT:
+            end = 'halt'
+            break
+
+        else:
+            print "Error: Unknown instruction ", refm.compiled_program[instr_ptr]
+            end = 'error'
+            break
+
+        instr_ptr += 1
+
+    # AIQ counts any cycle that uses all the steps as over time
+    if step == max_steps: end = 'overtime'
+
+    state.work_ptr = work_ptr
+    refm.step = step
+
+    profile = refm.profile
+    profile.cycles += 1
+    for op in range(len(counts)):
+        profile.opcodes[OPCODE_NAMES[op]] += counts[op]
+    profile.steps[step] = profile.steps.get( step, 0 ) + 1
+    profile.ends[end] += 1
+
+    return step
@@ -9,59 +9,180 @@
 
 import random
 from numpy import zeros, ones, array
-from scipy import linspace, stats, floor, sqrt
+from scipy import linspace, stats, floor, sqrt, ceil
 from string import replace, lower
-import getopt, sys
+from multiprocessing import Pool
+from itertools import imap
+from time import time
+import getopt, sys, os
 from os.path import isfile
+from ast import literal_eval
 
 import BF
+import BF_analyser
+from RandomStream import RandomStream
 
 
 STRATA = 21
 
+CHUNK_SIZE = 100 # programs sampled by each task, and between checkpoints
 
-# get a random program, excluding over time and passive ones
-def active_program( refm ):
+# the ways a program can be rejected, by class and whether the analyser proved it
+REJECTIONS = [ ( 0, True), (-1, True), (0, False), (-1, False) ]
+REJECTION_NAMES = { ( 0, True)  : "passive, proven by analyser",
+                    (-1, True)  : "over time, proven by analyser",
+                    ( 0, False) : "passive",
+                    (-1, False) : "over time" }
 
-    program = refm.random_program()
-    env_class = test_class( refm, program )
-    while env_class == -1 or env_class == 0:
+
+# Cache of program classes, so that a program that has been sampled before
+# doesn't need to be tested again.  The classes are kept in a file for each
+# reference machine, which is shared by all runs of the sampler and all
+# cluster nodes.  A run only uses the classes that were in the file when it
+# started and the ones it works out itself, so that the samples don't depend
+# on the order that the chunks of a run finish in.  The programs are tested
+# with their own random numbers, so that the programs sampled don't depend
+# on which of them were in the cache.
+class ClassCache:
+
+    def __init__( self, known, rng ):
+        self.known = known # classes from the file, keyed by canonical program,
+                           # or None to test every program
+        self.rng   = rng   # random numbers for testing programs
+        self.new   = {}    # classes worked out since
+        self.hits  = 0
+
+    # get the class of a program, testing it if it isn't in the cache
+    def classify( self, refm, program ):
+
+        if self.known == None: return test_class( refm, program, self.rng )
+
+        key = BF.canonical_program( program )
+
+        env_class = self.new.get( key )
+        if env_class == None: env_class = self.known.get( key )
+
+        if env_class == None:
+            env_class = test_class( refm, program, self.rng )
+            self.new[key] = env_class
+        else:
+            self.hits += 1
+
+        return env_class
+
+
+# the classes from the cache file, loaded before the sampling starts
+known_classes = {}
+
+
+# load the classes from the first lines of a cache file, returns the classes
+# and the number of lines read.  Several processes can append to the file at
+# once, so a line that is still being written is left for later and any line
+# that doesn't parse is skipped.
+def load_classes( file_name, max_lines ):
+
+    classes = {}
+    lines = 0
+    if isfile( file_name ):
+        cache_file = open( file_name )
+        for line in cache_file:
+            if lines == max_lines or not line.endswith( "\n" ): break
+            lines += 1
+            fields = line.split()
+            if len(fields) != 2 or not valid_program( fields[1] ): continue
+            try:
+                classes[fields[1]] = int( fields[0] )
+            except ValueError:
+                continue
+        cache_file.close()
+
+    return classes, lines
+
+
+# check that a program from a file is made of BF instructions and ends with #
+def valid_program( program ):
+
+    for instr in program:
+        if instr not in BF.INSTRUCTIONS: return False
+
+    return program.endswith( '#' )
+
+
+# append the new classes to the end of a cache file in a single write, so
+# that they don't get mixed up with lines from other processes
+def save_classes( file_name, classes ):
+
+    if classes == {}: return
+
+    lines = [ str(s) + " " + program + "\n" for program, s in classes.items() ]
+    cache_file = open( file_name, 'a' )
+    cache_file.write( "".join( lines ) )
+    cache_file.close()
+
+
+# get a random program, excluding over time and passive ones.  Programs that
+# can be proven to be in one of these classes are rejected without running them.
+# If a dictionary of rejections is given the rejected programs are counted in
+# it, and if a ClassCache is given it is used to classify the programs.
+def active_program( refm, rejections=None, classes=None ):
+
+    while True:
         program = refm.random_program()
-        env_class = test_class( refm, program )
-        
-    return program, env_class
 
+        env_class = BF_analyser.analyse( refm, program )
+        proven = env_class != None
+        if not proven:
+            if classes != None: env_class = classes.classify( refm, program )
+            else:               env_class = test_class( refm, program )
 
-# Test an environment 4 times to determine its class with higher probability
+        if env_class != -1 and env_class != 0:
+            return program, env_class
 
-def test_class( refm, program ):
+        if rejections != None: rejections[ (env_class, proven) ] += 1
+
+
+# Test an environment 5 times to determine its class with higher probability.
+# The trials run a cycle at a time in turn, so that as soon as one of them
+# goes over time, which puts the program in the over time class whatever
+# the others do, the test can stop.  Each trial has its own machine state
+# and random numbers, so the results don't depend on the order they run in.
+# The random numbers for the trials come from rng, or the machine's random
+# numbers if it isn't given.
+
+def test_class( refm, program, rng=None ):
 
     # must be passive as it lacks read and/or write
     if program.count('.') == 0 or program.count(',') == 0: return 0
 
     cycles = 200 # cycles to run test for
+    trials = 5
 
-    s1, r1 = _test_class( refm, cycles, program )
-    s2, r2 = _test_class( refm, cycles, program )
-    s3, r3 = _test_class( refm, cycles, program )
-    s4, r4 = _test_class( refm, cycles, program )
-    s5, r5 = _test_class( refm, cycles, program )
-
-    #print program
-
-    # one "over time" puts it in the "over time" class
-    if s1 == -1 or s2 == -1 or s3 == -1 or s4 == -1 or s5 == -1:
-        #print "found overtime ", s1, s2, s3, s4, s5
-        return -1
+    state, refm_rng = refm.state, refm.rng
+    if rng == None: rng = refm_rng
+    seed = rng.randrange( 2**31 )
+    runs = [ _test_class( refm, cycles, program, RandomStream( seed, t ) ) \
+             for t in range(trials) ]
 
     # same rewards on each run (excluding first 5 cycles)
     # puts it in the "passive" class
-    if  all(r1[4:] == r2[4:])\
-    and all(r1[4:] == r3[4:])\
-    and all(r1[4:] == r4[4:])\
-    and all(r1[4:] == r5[4:]): return 0
-        
-        
+    passive = True
+
+    for i in range( cycles ):
+        rewards = [ run.next() for run in runs ]
+
+        # one "over time" puts it in the "over time" class
+        if None in rewards:
+            refm.state, refm.rng = state, refm_rng
+            return -1
+
+        if i >= 4 and rewards.count( rewards[0] ) != trials: passive = False
+
+    refm.state, refm.rng = state, refm_rng
+
+    if passive: return 0
+
+    s1, s2, s3, s4, s5 = [ run.next() for run in runs ]
+
     if s1 == s2 == s3 == s4 == s5 != 99:  # if all agree and not "other"
         return s1
     else:
@@ -85,13 +206,21 @@ def test_class( refm, program ):
 # against a random agent and seeing what happens in one trial.
 # This isn't very reliable, so use test_class intead which takes
 # several trials.
-
-def _test_class( refm, cycles, program ):
-
+#
+# This is a generator that runs a cycle each time it is resumed and yields
+# the reward symbol, or None if the cycle went over time.  After the last
+# cycle it yields the class.  The trial has its own machine state and uses
+# the given random numbers, so trials can be interleaved on one machine.
+
+def _test_class( refm, cycles, program, rng ):
+
+    state = BF.BFState()
+    state.work_tape   = []
+    state.input_tape  = []
+    state.output_tape = []
+    refm.state = state
     refm.init_machine()
 
-    env_overtime = False
-    
     env_copy     = True
     env_1back    = True
     env_2back    = True
@@ -102,6 +231,7 @@ def _test_class( refm, cycles, program ):
     env_1backdec = True
     env_cp_ex    = True
     env_1back_ex = True
+    env_any      = True # some of the above are still true
 
     env_type = 0
 
@@ -109,91 +239,217 @@ def _test_class( refm, cycles, program ):
     oa = 0
     o_r = 0
 
-    rewards = zeros( (cycles) )
-    
-    for i in range( cycles ):
+    num_symbols = refm.num_symbols
+    mid_symbol  = refm.mid_symbol
+    input_len   = refm.input_tape_len
+    max_steps   = refm.max_steps
+    compute     = refm.compute
+    randrange   = rng.randrange
+    input_tape  = state.input_tape
 
-        # run with random actions
-        input_data = [random.randrange(refm.num_symbols) \
-                      for j in range(refm.action_cells)]
-        refm.load_input( input_data )
-        steps = refm.compute( program )
+    for i in range( cycles ):
 
-        #print input_tape[:INPUT_LENGTH], " ", output_tape[0], output_tape[1:], work_tape[0:5]
+        refm.state = state
+        refm.rng   = rng
 
-        a = refm.input_tape[0]
+        # run with a random action, loading it into the input tape as
+        # load_input does
+        a = randrange(num_symbols)
+        start = state.input_start-1
+        if start < -input_len: start += input_len
+        state.input_start = start
+        input_tape[start] = a
 
-        if not refm.reverse_output:
-            r = refm.output_tape[0]
-        else:
-            r = refm.output_tape[refm.obs_cells]
+        steps = compute( program )
 
-        rewards[i] = r
+        if steps == max_steps:
+            yield None
+            return
 
-        if steps == refm.max_steps:
-            env_overtime = True
-            break
+        r = refm.get_reward_symbol()
 
         # ignore the first 5 cycles as they tend to have startup junk in them
-        if i > 5:
-            if r != a:                            env_copy     = False
-            if r != oa:                           env_1back    = False
-            if r != ooa:                          env_2back    = False
-            if r != oooa:                         env_3back    = False
-            if r != (a+1)%refm.num_symbols:       env_inc      = False
-            if r != (a-1)%refm.num_symbols:       env_dec      = False
-            if r != (oa+1)%refm.num_symbols:      env_1backinc = False
-            if r != (oa-1)%refm.num_symbols:      env_1backdec = False
-            if r != a and a != refm.mid_symbol:   env_cp_ex    = False
-            if r != oa and oa != refm.mid_symbol: env_1back_ex = False
+        if i > 5 and env_any:
+            if r != a:                       env_copy     = False
+            if r != oa:                      env_1back    = False
+            if r != ooa:                     env_2back    = False
+            if r != oooa:                    env_3back    = False
+            if r != (a+1)%num_symbols:       env_inc      = False
+            if r != (a-1)%num_symbols:       env_dec      = False
+            if r != (oa+1)%num_symbols:      env_1backinc = False
+            if r != (oa-1)%num_symbols:      env_1backdec = False
+            if r != a and a != mid_symbol:   env_cp_ex    = False
+            if r != oa and oa != mid_symbol: env_1back_ex = False
+
+            env_any = env_copy or env_1back or env_2back or env_3back \
+                      or env_inc or env_dec or env_1backinc or env_1backdec \
+                      or env_cp_ex or env_1back_ex
 
         oooa = ooa
         ooa = oa
         oa = a
         o_r = r
 
-    if env_overtime:
-        env_type = -1
+        yield r
+
+    if   env_copy:     env_type =  1
+    elif env_1back:    env_type =  2
+    elif env_2back:    env_type =  3
+    elif env_3back:    env_type =  4
+    elif env_inc:      env_type =  5
+    elif env_dec:      env_type =  6
+    elif env_1backinc: env_type =  7
+    elif env_1backdec: env_type =  8 
+    elif env_cp_ex:    env_type =  9 
+    elif env_1back_ex: env_type = 10
     else:
-        if   env_copy:     env_type =  1
-        elif env_1back:    env_type =  2
-        elif env_2back:    env_type =  3
-        elif env_3back:    env_type =  4
-        elif env_inc:      env_type =  5
-        elif env_dec:      env_type =  6
-        elif env_1backinc: env_type =  7
-        elif env_1backdec: env_type =  8 
-        elif env_cp_ex:    env_type =  9 
-        elif env_1back_ex: env_type = 10
-        else:
-            env_type = 99
+        env_type = 99
+
+    yield env_type
+
+
+
+# sample a chunk of programs into a part file, returns the chunk, the number
+# of programs, the rejections, the number of programs classified from the
+# cache, the new classes for the cache and the time taken.  The random numbers
+# only depend on the seed and the chunk, so a run gives the same samples
+# however many processes it uses.  The part file is written under a temporary
+# name and then renamed, so it only exists once the chunk is complete.
+def sample_chunk( args ):
 
-    return env_type, rewards
+    refm_call, seed, chunk, size, part_name, use_cache = args
 
+    start = time()
+
+    refm = eval( refm_call )
+    refm.rng = RandomStream( seed, chunk )
+
+    trial_rng = RandomStream( seed, chunk, "trials" )
+    if use_cache: classes = ClassCache( known_classes, trial_rng )
+    else:         classes = ClassCache( None, trial_rng )
+
+    rejections = dict( [(r, 0) for r in REJECTIONS] )
+    lines = []
+    for i in range( size ):
+        program, s = active_program( refm, rejections, classes )
+        lines.append( str(s) + " " + program + "\n" )
+
+    part_file = open( part_name + ".tmp", 'w' )
+    part_file.writelines( lines )
+    part_file.close()
+    os.rename( part_name + ".tmp", part_name )
+
+    return chunk, size, rejections, classes.hits, classes.new, time()-start
+
+
+# read the stratum of each program in a part or sample file
+def read_strata( file_name ):
+    sample_file = open( file_name )
+    strata = [ int(line.split()[0]) for line in sample_file ]
+    sample_file.close()
+    return strata
+
+
+# Read the strata counts that go with a sample file, or None if there are
+# none.  When a sample file only keeps some of the programs that were sampled
+# in each stratum the counts record how many were sampled, so that AIQ can
+# estimate the strata probabilities from them rather than from the file.
+def read_counts( counts_name ):
+
+    if not isfile( counts_name ): return None
+
+    counts = zeros( (STRATA) )
+    counts_file = open( counts_name )
+    for line in counts_file:
+        s, count = line.split()
+        counts[int(s)] = float(count)
+    counts_file.close()
+
+    return counts
+
+
+def write_counts( counts_name, counts ):
+    counts_file = open( counts_name, 'w' )
+    for s in range( 1, STRATA ):
+        counts_file.write( str(s) + " " + str(int(counts[s])) + "\n" )
+    counts_file.close()
+
+
+# The number of programs to keep for each stratum in quota mode, given the
+# number sampled so far.  Every stratum that has been seen needs at least
+# min_count programs, and enough for an AIQ run of aiq_size samples, which
+# takes a stratum's share of them divided by 2 as each program is run twice.
+# The adaptive allocation can give a stratum more than its share, and runs
+# that fail are replaced by new programs, so allow AIQ_MARGIN times as many.
+AIQ_MARGIN = 3.0
+
+def strata_quotas( counts, min_count, aiq_size ):
+    p = counts/counts.sum()
+    quotas = ceil( AIQ_MARGIN*aiq_size*p/2.0 )
+    quotas[quotas < min_count] = min_count
+    quotas[counts == 0] = 0
+    return quotas
+
+
+# the largest standard error of the strata probabilities estimated from
+# the counts
+def strata_error( counts ):
+    n = counts.sum()
+    p = counts/n
+    return sqrt( p*(1.0-p)/n ).max()
+
+
+# Whether every program in a sample file is in canonical form.  Older
+# versions of the sampler only removed each cancelling pair once, which
+# left some programs not fully reduced.
+def canonical_samples( file_name ):
+    sample_file = open( file_name )
+    for line in sample_file:
+        fields = line.split()
+        if len(fields) == 2 and BF.canonical_program( fields[1] ) != fields[1]:
+            sample_file.close()
+            return False
+    sample_file.close()
+    return True
 
 
 def usage():
     print
     print "AIQ program sample classifier"
     print
-    print "python BF_sampler.py -s sample_size -r ref_machine[,para1[,para2[...]]]"
+    print "python BF_sampler.py -s sample_size -r ref_machine[,para1[,para2[...]]] " \
+          + "[-n cluster_node] [-p processes] [--seed seed] [--append] [--overwrite] " \
+          + "[--no_cache] [--min_count count] [--aiq_size size] [--tolerance error]"
     print
 
     
 
 def main():
 
+    global known_classes
+
     print
     print "BF reference machine program sampler"
     print
 
-    sample_size = 0
-    refm_str = None
-    refm_params = []
+    sample_size  = 0
+    refm_str     = None
+    refm_params  = []
+    cluster_node = ""
+    processes    = 1
+    seed         = None
+    mode         = None
+    use_cache    = True
+    min_count    = 0
+    aiq_size     = 0
+    tolerance    = 0.0
 
     # get the command line arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "s:r:", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "s:r:n:p:",
+                                   ["help", "seed=", "append", "overwrite",
+                                    "no_cache", "min_count=", "aiq_size=",
+                                    "tolerance="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -212,12 +468,26 @@ def main():
             refm_str = args.pop(0)
             for a in args:
                 refm_params.append( float(a) )
+        elif opt == "-n":          cluster_node = "_"+arg
+        elif opt == "-p":          processes    = int(arg)
+        elif opt == "--seed":      seed         = int(arg)
+        elif opt == "--append":    mode         = 'a'
+        elif opt == "--overwrite": mode         = 'w'
+        elif opt == "--no_cache":  use_cache    = False
+        elif opt == "--min_count": min_count    = int(arg)
+        elif opt == "--aiq_size":  aiq_size     = int(arg)
+        elif opt == "--tolerance": tolerance    = float(arg)
         else:
             print "Unrecognised option"
             usage()
             sys.exit()
 
-    if sample_size == 0:
+    # In quota mode sampling carries on until every stratum has enough
+    # programs and the strata probabilities are known well enough, with the
+    # sample size, if given, as a limit on the number of programs sampled
+    quota_mode = min_count > 0 or aiq_size > 0 or tolerance > 0.0
+
+    if sample_size == 0 and not quota_mode:
         print "Error: No sample size set"
         sys.exit()
 
@@ -238,38 +508,223 @@ def main():
     for param in refm_params: refm_call += "," + str(int(param))
     refm_call += ")"
 
-    # create reference machine
-    refm = eval( refm_call )
-
-    # output filename
+    # output filename, with the cluster node added in the way AIQ expects
     file_name = "./samples/"
     file_name += refm_call.partition('.')[2] # strip off the module name and dot
-    file_name += ".samples"
+    file_name += cluster_node + ".samples"
+    counts_name = file_name[:-len(".samples")] + ".counts"
+
+    # the cache of classes is shared by all runs for this reference machine
+    cache_name = "./samples/" + str( eval( refm_call ) ) + ".classes"
 
     print "Output filename: " + file_name
-    print
 
-    # check for existing sample file
-    if isfile( file_name ):
-        print "Output sample file already exists, do you want to:"
-        choice = lower(raw_input(" Append, Overwrite or Quit [a/o/q] ? "))
-        if   choice == 'a': mode = 'a'
-        elif choice == 'o': mode = 'w'
-        else: sys.exit()
+    # The checkpoint records the settings of a run, including how many lines
+    # of the class cache it uses, and each chunk of samples is kept in its own
+    # part file until they are all done.  If the run is interrupted it can be
+    # resumed by running the same command again.
+    checkpoint_name = file_name + ".checkpoint"
+    settings = [ sample_size, min_count, aiq_size, tolerance ]
+
+    if isfile( checkpoint_name ):
+        checkpoint = open( checkpoint_name )
+        try:
+            old_seed, old_mode, cache_lines, old_settings = checkpoint.read().split( None, 3 )
+            old_seed, cache_lines = int(old_seed), int(cache_lines)
+            old_settings = literal_eval( old_settings )
+            if old_mode not in ['a', 'w']: raise ValueError
+        except (ValueError, SyntaxError):
+            print "Error: Can't read the checkpoint, remove " + checkpoint_name \
+                  + " to start again"
+            sys.exit()
+        checkpoint.close()
+        if (seed != None and seed != old_seed) or settings != old_settings:
+            print "Error: An unfinished run with a different seed or settings " \
+                  "exists, remove " + checkpoint_name + " to start again"
+            sys.exit()
+        if mode != None and mode != old_mode:
+            if old_mode == 'a': action = "appends to"
+            else:               action = "overwrites"
+            print "Error: An unfinished run that " + action + " the sample file " \
+                  "exists, remove " + checkpoint_name + " to start again"
+            sys.exit()
+        seed, mode = old_seed, old_mode
+        use_cache = cache_lines >= 0
+        if use_cache:
+            known_classes, cache_lines = load_classes( cache_name, cache_lines )
+        print "Resuming unfinished run"
     else:
-        mode = 'w'
+        # check for existing sample file
+        if isfile( file_name ) and mode == None:
+            print "Output sample file already exists, do you want to:"
+            choice = lower(raw_input(" Append, Overwrite or Quit [a/o/q] ? "))
+            if   choice == 'a': mode = 'a'
+            elif choice == 'o': mode = 'w'
+            else: sys.exit()
+        elif mode == None:
+            mode = 'w'
+
+        if mode == 'a' and isfile( file_name ) and not canonical_samples( file_name ):
+            print "Error: " + file_name + " was made by an older sampler that didn't " \
+                  "fully reduce programs, so appending would mix the two forms, " \
+                  "overwrite it or use another cluster node name"
+            sys.exit()
 
-    sample_file = open( file_name, mode )
-    
+        if seed == None: seed = random.SystemRandom().randrange( 2**31 )
+
+        if use_cache:
+            known_classes, cache_lines = load_classes( cache_name, -1 )
+        else:
+            cache_lines = -1
 
-    # generate the samples
-    for i in range( sample_size ):
-        program, s = active_program( refm )
-        sample_file.write( str(s) + " " + program + "\n" )
-        sample_file.flush()
+        checkpoint = open( checkpoint_name, 'w' )
+        checkpoint.write( str(seed) + " " + mode + " " + str(cache_lines) + " " \
+                          + str(settings) + "\n" )
+        checkpoint.close()
 
+    print "Random seed:     " + str(seed)
+    if use_cache:
+        print "Class cache:     " + cache_name + ", " + str(len(known_classes)) \
+              + " programs"
+    print
+
+    # the samples are made in chunks, which are worked through in order in
+    # batches of tasks for the processes, skipping the chunks already done
+    if sample_size > 0: chunks = (sample_size+CHUNK_SIZE-1)/CHUNK_SIZE
+    else:               chunks = None
+    batch_size = 4*processes
+
+    part_name = lambda chunk: file_name + ".part" + str(chunk)
+
+    if processes == 1: pool = None
+    else:              pool = Pool( processes )
+
+    start = time()
+    sampled = 0
+    rejections = dict( [(r, 0) for r in REJECTIONS] )
+    hits = 0
+    written = set() # programs added to the cache file by this run
+    counts = zeros( (STRATA) ) # programs sampled in each stratum
+    last_chunk = None
+
+    chunk = 0
+    while last_chunk == None:
+
+        batch = range( chunk, chunk+batch_size )
+        if chunks != None: batch = batch[:chunks-chunk]
+
+        tasks = []
+        for c in batch:
+            size = CHUNK_SIZE
+            if chunks != None: size = min( size, sample_size-c*CHUNK_SIZE )
+            if not isfile( part_name(c) ):
+                tasks.append( (refm_call, seed, c, size, part_name(c), use_cache) )
+
+        if pool == None: results = imap( sample_chunk, tasks )
+        else:            results = pool.imap( sample_chunk, tasks )
+
+        for c, size, chunk_rejections, chunk_hits, new_classes, seconds in results:
+            sampled += size
+            for r in REJECTIONS: rejections[r] += chunk_rejections[r]
+            hits += chunk_hits
+            print " chunk % 5d  % 7d programs  % 8.1f programs/sec" \
+                  % (c, sampled, sampled/(time()-start))
+
+            # add the new classes to the end of the cache file, which the
+            # checkpoint makes sure this run doesn't read back in if it resumes
+            if use_cache:
+                chunk_classes = {}
+                for program, s in new_classes.items():
+                    if program not in known_classes and program not in written:
+                        chunk_classes[program] = s
+                        written.add( program )
+                save_classes( cache_name, chunk_classes )
+
+        # count the samples in each stratum, chunk by chunk, and in quota mode
+        # stop at the first chunk where the quotas are met and the strata
+        # probabilities have converged, so where a run stops doesn't depend
+        # on the batches
+        for c in batch:
+            for s in read_strata( part_name(c) ): counts[s] += 1
+
+            if quota_mode:
+                quotas = strata_quotas( counts, min_count, aiq_size )
+                if (counts >= quotas).all() \
+                       and (tolerance == 0.0 or strata_error( counts ) <= tolerance):
+                    last_chunk = c
+                    break
+
+            if c+1 == chunks:
+                last_chunk = c
+                if quota_mode:
+                    print
+                    print "Warning: Reached the sample size before the quotas were met"
+
+        chunk += batch_size
+
+    if pool != None:
+        pool.close()
+        pool.join()
+
+    # report throughput and how many programs were rejected
+    seconds = time()-start
+    if sampled > 0:
+        print
+        print "Sampled %d programs in %.1f seconds, %.1f programs/sec" \
+              % (sampled, seconds, sampled/seconds)
+        print "Rejected programs:"
+        for r in REJECTIONS:
+            print " % 8d  %s" % (rejections[r], REJECTION_NAMES[r])
+        if use_cache:
+            print "Programs classified from the cache: %d" % hits
+
+    # Strata counts for the file.  When appending, add on the counts that
+    # are already there, which are just the number of programs in each
+    # stratum if the file has no counts.
+    old_counts = None
+    if mode == 'a' and isfile( file_name ):
+        old_counts = read_counts( counts_name )
+        if old_counts is None and quota_mode:
+            old_counts = zeros( (STRATA) )
+            for s in read_strata( file_name ): old_counts[s] += 1
+
+    # merge the part files in order and finish the run.  In quota mode only
+    # the first programs in each stratum up to its quota are kept.
+    if quota_mode:
+        quotas = strata_quotas( counts, min_count, aiq_size )
+        print
+        print "Strata counts, sampled and kept:"
+        print counts[1:]
+        print quotas[1:]
+        print "Largest standard error of the strata probabilities: %.4f" \
+              % strata_error( counts )
+    kept = zeros( (STRATA) )
+
+    sample_file = open( file_name, mode )
+    for c in range( last_chunk+1 ):
+        part_file = open( part_name(c) )
+        for line in part_file:
+            s = int(line.split()[0])
+            if not quota_mode or kept[s] < quotas[s]:
+                sample_file.write( line )
+                kept[s] += 1
+        part_file.close()
     sample_file.close()
 
+    if quota_mode or old_counts is not None:
+        if old_counts is not None: counts += old_counts
+        write_counts( counts_name, counts )
+        print "Strata counts:   " + counts_name
+    elif isfile( counts_name ):
+        os.remove( counts_name ) # the counts for an overwritten file
+
+    # remove all the part files, including any made after the last chunk
+    c = 0
+    while c <= last_chunk or isfile( part_name(c) ):
+        if isfile( part_name(c) ): os.remove( part_name(c) )
+        c += 1
+    os.remove( checkpoint_name )
+
 
 if __name__ == "__main__":
     main()
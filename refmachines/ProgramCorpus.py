@@ -0,0 +1,315 @@
+#
+# Packed binary corpus of program samples.
+#
+# A corpus holds the same programs and strata as a text sample file from
+# BF_sampler, but with each instruction packed into 4 bits and the programs
+# of each stratum stored together, with an index of where each program
+# starts.  A corpus file is memory mapped rather than read, so opening one
+# only reads its header, forked processes share the one copy of it, and
+# getting the next program of a stratum doesn't depend on the size of the
+# corpus.
+#
+# The file layout, with all numbers little endian, is:
+#
+#   magic      4 bytes    "AIQC"
+#   version    uint32
+#   strata     uint32     number of strata
+#   programs   uint32     number of programs
+#   alphabet   16 bytes   the instruction with each 4 bit code, 0 padded
+#   kept       uint64     programs in the corpus, for each stratum
+#   sampled    float64    programs sampled, for each stratum
+#   start      uint64     first program of each stratum, and the end
+#   offsets    uint32     first code of each program, and the end
+#   order      uint32     program at each line of the original sample file
+#   features   int8       the FEATURES of each program, in stratum order
+#   codes      bytes      instruction codes, two to a byte, high bits first
+#
+# The sampled counts are the kept ones unless the sample file came with a
+# .counts file from BF_sampler's quota mode.
+#
+# The features are cheap static properties of the programs that AIQ can use
+# to split strata into sub-strata, see refine.  They are clipped to fit in
+# a byte, which is plenty for telling programs apart.
+#
+# Run this to convert a text sample file, for example:
+#
+#   python ProgramCorpus.py "samples/BF(5).samples"
+#
+# writes samples/BF(5).corpus, including any counts in samples/BF(5).counts.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+import mmap, struct, sys
+from os.path import isfile
+
+from numpy import zeros, array, frombuffer, argsort, cumsum, searchsorted, \
+     arange, bincount, unique, percentile, concatenate, \
+     clip, uint8, int8, uint32, uint64, float64
+
+
+MAGIC   = "AIQC"
+VERSION = 2
+
+# the static features of each program, see program_features
+FEATURES = [ "length", "depth", "reads", "writes", "randoms", "balance" ]
+
+MIN_PROGRAMS = 50 # least programs in a sub-stratum made by refine
+
+HEADER = struct.Struct( "<4sIII16s" )
+
+
+class ProgramCorpus:
+
+    # buffer is the packed corpus, such as a string or a memory map
+    def __init__( self, buffer ):
+
+        magic, version, strata, programs, alphabet = HEADER.unpack_from( buffer, 0 )
+        if magic != MAGIC or version != VERSION:
+            raise NameError("Not a version " + str(VERSION) + " program corpus, " \
+                            + "convert the sample file again")
+
+        self.buffer     = buffer
+        self.num_strata = strata
+        self.size       = programs
+        self.alphabet   = alphabet.rstrip( "\0" )
+
+        position = HEADER.size
+        self.kept,    position = _array( buffer, position, "<u8", strata )
+        self.sampled, position = _array( buffer, position, "<f8", strata )
+        self.start,   position = _array( buffer, position, "<u8", strata+1 )
+        self.offsets, position = _array( buffer, position, "<u4", programs+1 )
+        self.order,   position = _array( buffer, position, "<u4", programs )
+        self.features, position = _array( buffer, position, "i1",
+                                          programs*len(FEATURES) )
+        self.features = self.features.reshape( (programs, len(FEATURES)) )
+        self.codes = position
+
+        # the two instructions for each byte of codes
+        self.pairs = [ _symbol( self.alphabet, b >> 4 ) + _symbol( self.alphabet, b & 15 ) \
+                       for b in range(256) ]
+
+        # the next program to draw from each stratum, and the end of each,
+        # as positions in index, or in the programs themselves if it's None
+        self.index   = None
+        self.cursors = [ int(i) for i in self.start[:-1] ]
+        self.ends    = [ int(i) for i in self.start[1:] ]
+
+    def __len__( self ):
+        return self.size
+
+    # the program with the given index
+    def program( self, index ):
+        begin = int( self.offsets[index] )
+        end   = int( self.offsets[index+1] )
+        data = self.buffer[ self.codes + begin/2 : self.codes + (end+1)/2 ]
+        pairs = self.pairs
+        program = "".join( [ pairs[ord(b)] for b in data ] )
+        return program[ begin%2 : begin%2 + end-begin ]
+
+    # number of programs left to draw in a stratum
+    def remaining( self, stratum ):
+        return self.ends[stratum] - self.cursors[stratum]
+
+    # the next program in a stratum, or None if there are none left
+    def draw( self, stratum ):
+        position = self.cursors[stratum]
+        if position == self.ends[stratum]: return None
+        self.cursors[stratum] = position + 1
+        if self.index is None: return self.program( position )
+        return self.program( int( self.index[position] ) )
+
+    # the stratum of the program with the given index
+    def stratum( self, index ):
+        return int( searchsorted( self.start, index, side='right' ) ) - 1
+
+    # all the (stratum, program) pairs, in the order of the sample file,
+    # with the strata the programs were stored in
+    def programs( self ):
+        for index in self.order:
+            yield self.stratum( index ), self.program( index )
+
+    # Split the strata into sub-strata by the given features, a list of
+    # (feature, bins) with feature an index into FEATURES.  Each feature in
+    # turn splits every sub-stratum into bins at quantiles of the feature,
+    # unless that would make one with fewer than MIN_PROGRAMS programs.  The
+    # passive stratum 0 is left as it is.  Afterwards draw, kept and sampled
+    # refer to the sub-strata, and sampled divides the programs sampled in
+    # each stratum between its sub-strata in proportion to the programs
+    # kept.  Returns the stratum of each sub-stratum.
+    def refine( self, splits ):
+
+        groups = []
+        parents = []
+        for stratum in range( self.num_strata ):
+            stratum_groups = [ arange( self.start[stratum], self.start[stratum+1], dtype=int ) ]
+            if stratum == 0: splits_left = []
+            else:            splits_left = splits
+            for feature, bins in splits_left:
+                new_groups = []
+                for group in stratum_groups:
+                    values = self.features[group, feature]
+                    cuts = unique( percentile( values, [100.0*b/bins for b in range(1, bins)] ) )
+                    labels = searchsorted( cuts, values, side='right' )
+                    parts = [ group[labels == b] for b in range( len(cuts)+1 ) ]
+                    parts = [ part for part in parts if len(part) > 0 ]
+                    if min( map( len, parts ) ) >= MIN_PROGRAMS: new_groups += parts
+                    else:                                        new_groups.append( group )
+                stratum_groups = new_groups
+            groups += stratum_groups
+            parents += [stratum] * len(stratum_groups)
+
+        kept = array( map( len, groups ), dtype=uint64 )
+        start = zeros( (len(groups)+1), dtype=uint64 )
+        start[1:] = cumsum( kept )
+        parent_kept = self.kept[parents].astype( float64 )
+        parent_kept[parent_kept == 0] = 1.0
+
+        self.sampled = self.sampled[parents] * kept/parent_kept
+        self.kept = kept
+        self.num_strata = len(groups)
+        self.index = concatenate( groups )
+        self.cursors = [ int(i) for i in start[:-1] ]
+        self.ends    = [ int(i) for i in start[1:] ]
+
+        return parents
+
+
+def _array( buffer, position, dtype, length ):
+    values = frombuffer( buffer, dtype=dtype, count=length, offset=position )
+    return values, position + values.nbytes
+
+def _symbol( alphabet, code ):
+    if code < len(alphabet): return alphabet[code]
+    return "?"
+
+
+# The static features of a program: its length, the deepest nesting of its
+# loops, the number of reads, writes and random instructions, and how far
+# the pointer moves to the right less how far it moves to the left
+def program_features( program ):
+
+    depth = max_depth = 0
+    for instr in program.translate( _BRACKETS, _NOT_BRACKETS ):
+        if instr == '[':
+            depth += 1
+            if depth > max_depth: max_depth = depth
+        else:
+            depth -= 1
+
+    return [ len(program), max_depth, program.count(','), program.count('.'),
+             program.count('%'), program.count('>') - program.count('<') ]
+
+_BRACKETS = "".join( [ chr(i) for i in range(256) ] )
+_NOT_BRACKETS = _BRACKETS.replace( "[", "" ).replace( "]", "" )
+
+
+# Read a text sample file, and the counts file next to it if there is one,
+# returning lists of the strata and programs and the sampled counts
+def read_samples( file_name ):
+
+    strata   = []
+    programs = []
+    sample_file = open( file_name )
+    for line in sample_file:
+        s, program = line.split()
+        strata.append( int(s) )
+        programs.append( program )
+    sample_file.close()
+
+    num_strata = max( strata ) + 1
+    sampled = bincount( strata, minlength=num_strata ).astype( float64 )
+
+    counts_name = file_name[:-len(".samples")] + ".counts"
+    if isfile( counts_name ):
+        sampled = zeros( (num_strata) )
+        counts_file = open( counts_name )
+        for line in counts_file:
+            s, count = line.split()
+            if int(s) < num_strata: sampled[ int(s) ] = float(count)
+        counts_file.close()
+
+    return strata, programs, sampled
+
+
+# Pack programs and their strata into a corpus, returned as a string
+def pack( strata, programs, sampled ):
+
+    num_strata = len( sampled )
+    alphabet = "".join( sorted( set( "".join( programs ) ) ) )
+    if len(alphabet) > 16:
+        raise NameError("Programs use more than 16 instructions")
+    codes = zeros( (256), dtype=uint8 )
+    for i, c in enumerate( alphabet ): codes[ord(c)] = i
+
+    strata = array( strata, dtype=uint32 )
+    order = argsort( strata, kind='mergesort' ) # keeps file order within strata
+    index = zeros( (len(programs)), dtype=uint32 )
+    index[order] = arange( len(programs) )
+
+    kept = bincount( strata, minlength=num_strata ).astype( uint64 )
+    start = zeros( (num_strata+1), dtype=uint64 )
+    start[1:] = cumsum( kept )
+
+    programs = [ programs[i] for i in order ]
+    offsets = zeros( (len(programs)+1), dtype=uint64 )
+    offsets[1:] = cumsum( map( len, programs ) )
+
+    nibbles = codes[ frombuffer( "".join( programs ) + alphabet[0], dtype=uint8 ) ]
+    packed = (nibbles[0:-1:2] << 4) | nibbles[1::2]
+
+    features = array( map( program_features, programs ) )
+    features = features.reshape( (len(programs), len(FEATURES)) )
+    features = clip( features, -128, 127 ).astype( int8 )
+
+    return HEADER.pack( MAGIC, VERSION, num_strata, len(programs), alphabet ) \
+           + kept.astype( "<u8" ).tostring() \
+           + array( sampled, dtype=float64 ).astype( "<f8" ).tostring() \
+           + start.astype( "<u8" ).tostring() \
+           + offsets.astype( "<u4" ).tostring() \
+           + index.astype( "<u4" ).tostring() \
+           + features.tostring() \
+           + packed.tostring()
+
+
+# Load a text sample file as a corpus in memory
+def load_text( file_name ):
+    return ProgramCorpus( pack( *read_samples( file_name ) ) )
+
+
+# Memory map a corpus file
+def load_corpus( file_name ):
+    corpus_file = open( file_name, 'rb' )
+    buffer = mmap.mmap( corpus_file.fileno(), 0, access=mmap.ACCESS_READ )
+    corpus_file.close()
+    return ProgramCorpus( buffer )
+
+
+# Convert a text sample file to a corpus file
+def convert( file_name, corpus_name ):
+    corpus_file = open( corpus_name, 'wb' )
+    corpus_file.write( pack( *read_samples( file_name ) ) )
+    corpus_file.close()
+
+
+def main():
+
+    if len(sys.argv) not in [2, 3] or not sys.argv[1].endswith( ".samples" ):
+        print "python ProgramCorpus.py sample_file.samples [corpus_file]"
+        sys.exit()
+
+    file_name = sys.argv[1]
+    if len(sys.argv) == 3: corpus_name = sys.argv[2]
+    else:                  corpus_name = file_name[:-len(".samples")] + ".corpus"
+
+    convert( file_name, corpus_name )
+
+    corpus = load_corpus( corpus_name )
+    print "Wrote " + str(len(corpus)) + " programs to " + corpus_name
+    print "Programs in each stratum:"
+    print corpus.kept
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#
+# Seeded streams of random numbers for the reference machines and agents.
+#
+# A stream is identified by a key, such as ( run seed, program, copy, side,
+# role ), and gets its own generator seeded from a hash of the key, so the
+# random numbers a run uses depend only on what the run is and not on which
+# worker process it happened to be given.  This makes runs reproducible,
+# stops forked workers from repeating each other's random numbers, and gives
+# different agents the same random numbers in the same environment.  A
+# stream without a key is seeded from the operating system.
+#
+# The numbers are generated by NumPy in blocks, which is cheaper than
+# asking Python's random module for them one at a time.
+#
+# Copyright Shane Legg 2011
+# Released under GNU GPLv3
+
+
+import hashlib
+
+from numpy import frombuffer, uint32
+from numpy.random import RandomState
+
+
+BLOCK_SIZE = 1024 # random numbers to generate at a time
+
+
+class RandomStream:
+
+    def __init__( self, *key ):
+
+        if len(key) == 0:
+            self.generator = RandomState()
+        else:
+            digest = hashlib.sha1( repr(key) ).digest()
+            self.generator = RandomState( frombuffer( digest, dtype=uint32 ) )
+
+        # a float in [0,1), this is the next method of a generator so that
+        # getting a number doesn't need a Python level call
+        self.random = self.numbers().next
+
+    # the numbers in the stream, a block at a time
+    def numbers( self ):
+        while True:
+            for x in self.generator.random_sample( BLOCK_SIZE ).tolist():
+                yield x
+
+    # an integer in [0,n)
+    def randrange( self, n ):
+        return int( self.random()*n )
+
+    # an integer in [a,b]
+    def randint( self, a, b ):
+        return a + int( self.random()*(b-a+1) )
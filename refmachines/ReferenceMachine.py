@@ -17,6 +17,7 @@ class ReferenceMachine:
         self.num_actions     = 0
         self.obs_symbols     = 0
         self.obs_cells       = 0
+        self.steps_saved     = 0 # steps that the machine managed to skip
 
     # used for naming log files etc.
     def __str__( self ):
@@ -46,3 +47,26 @@ class ReferenceMachine:
         print "You need to override ReferenceMachine.act!"
 
         
+
+
+    # Run an agent in the environment for an episode, starting with a reset.
+    # The rewards the agent sees are multiplied by rflip.  Returns the
+    # discounted sum of these rewards and True if the machine failed, that is
+    # a cycle went over time, in which case the episode is stopped early.
+    def run_episode( self, agent, episode_length, disc_rate, rflip, program="" ):
+
+        disc_reward = 0.0
+        discount    = 1.0
+
+        reward, observations = self.reset( program )
+
+        for i in range( episode_length ):
+            action = agent.perceive( observations, rflip*reward )
+            reward, observations, steps = self.act( action )
+
+            if steps == self.max_steps: return (disc_reward, True)
+
+            disc_reward += discount*rflip*reward
+            discount    *= disc_rate
+
+        return (disc_reward, False)